@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the gtags module which run without Sublime Text.
+
+Micro benchmarks measure parsing and indexing on synthetic data.
+The tree benchmark generates a C source tree and times TagFile
+operations on it with the global and gtags binaries found in PATH:
+
+    python benchmark.py --suite tree --files 2000 --output new.json
+    python benchmark.py --suite tree --files 2000 --compare old.json
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import gtags
+import symbolindex
+import utils
+
+
+def synthetic_output(results, files=500):
+    return ''.join(
+        '/home/user/project/src/module%d/file%d.c:%d:'
+        '    LSQ_IteratorT iterator = LSQ_GetElementByIndex(handle, %d);\n' % (
+            i % 17, i % files, i + 1, i)
+        for i in xrange(results))
+
+
+def parse_dicts(output):
+    return [match.groupdict() for match in gtags.TAGS_RE.finditer(output)]
+
+
+def parse_tags(output):
+    return gtags.TagFile('.')._match_output(output)
+
+
+def format_dicts(records):
+    # The way results were shown before Tag records: linenum is a string.
+    return ['%s:%d' % (r['path'], int(r['linenum'])) for r in records]
+
+
+def format_tags(records):
+    return ['%s:%d' % (path, linenum) for path, linenum, _ in records]
+
+
+def deep_size(records):
+    seen = set()
+    total = sys.getsizeof(records)
+    for record in records:
+        values = record.values() if isinstance(record, dict) else record
+        for obj in [record] + list(values):
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+    return total
+
+
+def best_time(func, repeat):
+    gc.collect()
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_records(results=100000, repeat=3):
+    output = synthetic_output(results)
+    report = {}
+    for name, parse, format in (('dict', parse_dicts, format_dicts),
+                                ('tag', parse_tags, format_tags)):
+        records = parse(output)
+        report[name] = {
+            'parse_per_second': int(
+                results / best_time(lambda: parse(output), repeat)),
+            'parse_and_format_per_second': int(results / best_time(
+                lambda: format(parse(output)), repeat)),
+            'bytes': deep_size(records),
+        }
+    return report
+
+
+def bench_lazy_context(results=100000, files=500, shown=500, repeat=3):
+    """Compare grep results with ctags results and lazy contexts.
+
+    The source files are real, so that contexts are read from disk
+    through gtags.LINE_CACHE.
+    """
+    root = tempfile.mkdtemp()
+    try:
+        lines = results // files + 1
+        for i in xrange(files):
+            with open(os.path.join(root, 'file%d.c' % i), 'w') as source:
+                source.writelines(
+                    '    LSQ_IteratorT iterator = LSQ_GetElement(h, %d);\n' % n
+                    for n in xrange(lines))
+        locations = [(os.path.join(root, 'file%d.c' % (i % files)),
+                      i // files + 1) for i in xrange(results)]
+        # global prints results sorted by path.
+        locations.sort()
+        grep_output = ''.join('%s:%d:%s\n' % (path, line,
+            gtags.LineCache().line(path, line)) for path, line in locations)
+        ctags_output = ''.join('LSQ_IteratorT\t%s\t%d\n' % location
+                               for location in locations)
+        eager = gtags.TagFile(root)
+        lazy = gtags.TagFile(root, lazy_context=True)
+
+        def show(tags, count):
+            return [tag.context.strip()
+                    for tag in gtags.fill_contexts(tags[:count])]
+
+        def cold(func):
+            gtags.LINE_CACHE.clear()
+            return func()
+
+        report = {}
+        for name, tags, output in (('grep', eager, grep_output),
+                                   ('ctags', lazy, ctags_output)):
+            report[name] = {
+                'output_bytes': len(output),
+                'parse_ms': round(1000 * best_time(
+                    lambda: tags._match_output(output), repeat)),
+                'show_%d_ms' % shown: round(1000 * best_time(lambda: cold(
+                    lambda: show(tags._match_output(output), shown)),
+                    repeat)),
+                'show_all_ms': round(1000 * best_time(lambda: cold(
+                    lambda: show(tags._match_output(output), results)),
+                    repeat)),
+            }
+        return report
+    finally:
+        gtags.LINE_CACHE.clear()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_paths(results=100000, directories=500, files=5000, repeat=3):
+    """Compare per result path conversions with per directory ones.
+
+    8.3 name expansion only exists on Windows; elsewhere the number
+    of calls to a stand-in converter is reported instead of timings.
+    """
+    paths = ['/home/user/PROJEC~1/src/module%d/file%d.c' % (
+        i % directories, i % files) for i in xrange(results)]
+    calls = []
+
+    def convert(path):
+        calls.append(path)
+        return path.replace('PROJEC~1', 'project')
+
+    def per_result(func):
+        return lambda: [func(path) for path in paths]
+
+    def memoized(func):
+        def run():
+            utils.clear_path_memos()
+            return [func(path) for path in paths]
+        return run
+
+    report = {}
+    for name, func in (('normalize', per_result(utils._universal_normalize)),
+                       ('normalize_memo', memoized(utils.universal_normalize)),
+                       ('panel_path', per_result(os.path.normpath)),
+                       ('panel_path_memo', lambda: map(
+                           utils.per_directory(os.path.normpath), paths))):
+        report[name] = {'ms': round(1000 * best_time(func, repeat))}
+
+    # Before: one conversion per unique path of a query.
+    converted = {}
+    for path in paths:
+        if path not in converted:
+            converted[path] = convert(path)
+    report['convert_from_83'] = {'calls': len(calls)}
+    del calls[:]
+    utils.clear_path_memos()
+    for path in paths:
+        utils.long_path(path, convert)
+    report['convert_from_83_memo'] = {'calls': len(calls)}
+    return report
+
+
+def synthetic_symbols(count):
+    words = ('lsq', 'Get', 'set', 'Element', 'index', 'Handle', 'iterator',
+             'List', 'node', 'Create', 'destroy', 'Buffer', 'alloc', 'Free')
+    names = ('_'.join(parts) for length in itertools.count(2)
+             for parts in itertools.product(words, repeat=length))
+    return sorted('%s%d' % (name, i % 97)
+                  for i, name in itertools.izip(xrange(count), names))
+
+
+def bench_symbol_index(count=1000000, lookups=1000):
+    symbols = synthetic_symbols(count)
+    started = time.time()
+    index = symbolindex.SymbolIndex(symbols)
+    report = {'build': {'seconds': round(time.time() - started, 2)}}
+    queries = ('lsq_Get', 'Element_Free', 'handle_nod', 'zzz', 'Bu')
+    for query in queries:
+        seconds = best_time(
+            lambda: [index.search(query, 50) for _ in xrange(lookups)], 3)
+        report['search %r' % query] = {
+            'ms_per_lookup': round(1000 * seconds / lookups, 4)}
+    return report
+
+
+def generate_tree(root, files, functions=20, calls=5, seed=0):
+    """Write a C tree of files in directories of 50, return its symbols.
+
+    Every file defines functions and calls functions of other files;
+    every directory has a header declaring all of its functions.
+    The first function of the tree is called from every file.
+    """
+    rand = random.Random(seed)
+    names = [['dir%d_file%d_func%d' % (i // 50, i, j)
+              for j in xrange(functions)] for i in xrange(files)]
+    symbols = list(itertools.chain.from_iterable(names))
+    for i, functions_of_file in enumerate(names):
+        directory = os.path.join(root, 'dir%d' % (i // 50))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file%d.c' % i), 'w') as source:
+            source.write('#include "dir%d.h"\n\n' % (i // 50))
+            for name in functions_of_file:
+                source.write('int %s(int value)\n{\n' % name)
+                for callee in [symbols[0]] + rand.sample(symbols, calls):
+                    source.write('    value += %s(value);\n' % callee)
+                source.write('    return value;\n}\n\n')
+    for directory in xrange((files + 49) // 50):
+        path = os.path.join(root, 'dir%d' % directory, 'dir%d.h' % directory)
+        with open(path, 'w') as header:
+            for functions_of_file in names[directory * 50:][:50]:
+                header.writelines('int %s(int value);\n' % name
+                                  for name in functions_of_file)
+    return symbols
+
+
+def max_rss(who):
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return resource.getrusage(who).ru_maxrss // scale
+
+
+def operation_memory(func):
+    """Return peak RSS in kilobytes of one call of func and its children.
+
+    ru_maxrss is the peak over the whole life of a process, so after the
+    first large operation it says nothing about the next ones. The call
+    runs in a forked child instead, which starts from the memory in use
+    now: rss_growth_kb is what the operation itself added.
+    """
+    if resource is None or not hasattr(os, 'fork'):
+        # Peak memory is not reported on Windows.
+        return {}
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_end)
+            start = max_rss(resource.RUSAGE_SELF)
+            func()
+            os.write(write_end, json.dumps({
+                'peak_rss_kb': max_rss(resource.RUSAGE_SELF),
+                'rss_growth_kb': max_rss(resource.RUSAGE_SELF) - start,
+                'children_peak_rss_kb': max_rss(resource.RUSAGE_CHILDREN),
+            }))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    with os.fdopen(read_end) as result:
+        output = result.read()
+    _, status = os.waitpid(pid, 0)
+    return json.loads(output) if status == 0 else {}
+
+
+def time_operation(func, repeat, prepare=None):
+    """Time the first (cold) and the best of the next (warm) calls.
+
+    Memory is measured by one more call in a child process.
+    """
+    timings = []
+    for _ in xrange(repeat + 1):
+        if prepare is not None:
+            prepare()
+        gc.collect()
+        started = time.time()
+        result = func()
+        timings.append(time.time() - started)
+    report = {'cold_s': round(timings[0], 4),
+              'warm_s': round(min(timings[1:]), 4)}
+    if isinstance(result, list):
+        report['results'] = len(result)
+    if prepare is not None:
+        prepare()
+    gc.collect()
+    report.update(operation_memory(func))
+    return report
+
+
+def bench_tree(files=1000, functions=20, repeat=3, shards=4,
+               batch_symbols=1000):
+    root = tempfile.mkdtemp()
+    try:
+        started = time.time()
+        symbols = generate_tree(root, files, functions)
+        report = {'generate': {'seconds': round(time.time() - started, 4),
+                               'files': files, 'symbols': len(symbols)}}
+        tags = gtags.TagFile(root)
+        popular, rare = symbols[0], symbols[-1]
+        source = os.path.join(root, 'dir0', 'file0.c')
+        changed = [os.path.join(root, 'dir%d' % (i // 50), 'file%d.c' % i)
+                   for i in xrange(0, files, max(1, files // 10))]
+
+        def touch(paths):
+            for path in paths:
+                os.utime(path, None)
+
+        report['rebuild'] = time_operation(tags.rebuild, repeat)
+        report['rebuild_sharded'] = time_operation(
+            lambda: tags.rebuild(shards), repeat)
+        tags.rebuild()
+        report['match'] = time_operation(lambda: tags.match(rare), repeat)
+        report['match_references'] = time_operation(
+            lambda: tags.match(popular, reference=True), repeat)
+        report['by_prefix'] = time_operation(
+            lambda: tags.by_prefix(''), repeat)
+        report['parse_references'] = time_operation(
+            lambda: tags._match_output(tags.subprocess.query(
+                'global %s %s' % (tags._match_options(True), popular))),
+            repeat)
+        # One global per symbol is slow: time it once cold, once warm.
+        batch = random.Random(0).sample(symbols,
+                                        min(batch_symbols, len(symbols)))
+        report['match_loop_%d' % len(batch)] = time_operation(
+            lambda: [tags.match(symbol) for symbol in batch], 1)
+        report['match_many_%d' % len(batch)] = time_operation(
+            lambda: tags.match_many(batch), repeat)
+        report['update_file'] = time_operation(
+            lambda: tags.update_file(source), repeat,
+            prepare=lambda: touch([source]))
+        report['update'] = time_operation(
+            tags.update, repeat, prepare=lambda: touch(changed))
+        return report
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def print_report(title, report):
+    print title
+    for name, values in sorted(report.items()):
+        print '  %-20s %s' % (name, ', '.join(
+            '%s=%s' % item for item in sorted(values.items())))
+
+
+def timing_direction(metric):
+    """Return 1 for durations, -1 for rates and 0 for other metrics."""
+    if metric.endswith(('_s', 'ms', 'seconds', 'ms_per_lookup')):
+        return 1
+    if metric.endswith('_per_second'):
+        return -1
+    return 0
+
+
+def compare_reports(baseline, current, tolerance):
+    """Print timings of current relative to baseline.
+
+    Durations (cold_s, parse_ms, ms_per_lookup...) and rates
+    (parse_per_second...) are compared; sizes and counts are not.
+    Return the number of timings worse than baseline by more than
+    tolerance (0.2 is 20%).
+    """
+    regressions = 0
+    for suite, operations in sorted(current['suites'].items()):
+        print suite
+        for operation, values in sorted(operations.items()):
+            before = baseline['suites'].get(suite, {}).get(operation, {})
+            for metric, value in sorted(values.items()):
+                direction = timing_direction(metric)
+                if not direction or not before.get(metric) or not value:
+                    continue
+                ratio = (float(value) / before[metric]) ** direction
+                regression = ratio > 1 + tolerance
+                regressions += regression
+                print '  %-20s %-14s %11.4f -> %11.4f %+6.1f%%%s' % (
+                    operation, metric, before[metric], value,
+                    100 * (ratio - 1), '  REGRESSION' if regression else '')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--suite', choices=('micro', 'tree', 'all'),
+                        default='micro')
+    parser.add_argument('--files', type=int, default=1000,
+                        help='source files of the synthetic tree')
+    parser.add_argument('--functions', type=int, default=20,
+                        help='functions defined in every file')
+    parser.add_argument('--batch-symbols', type=int, default=1000,
+                        help='symbols resolved by match_many')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the report as JSON')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare with a JSON report of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    suites = {}
+    if args.suite in ('micro', 'all'):
+        suites['records'] = bench_records()
+        print_report('Result records (100k matches)', suites['records'])
+        suites['lazy_context'] = bench_lazy_context()
+        print_report('Lazy contexts (100k references)',
+                     suites['lazy_context'])
+        suites['paths'] = bench_paths()
+        print_report('Path normalization (100k results)', suites['paths'])
+        suites['symbol_index'] = bench_symbol_index()
+        print_report('Symbol index (1M symbols)', suites['symbol_index'])
+    if args.suite in ('tree', 'all'):
+        suites['tree'] = bench_tree(args.files, args.functions, args.repeat,
+                                    batch_symbols=args.batch_symbols)
+        print_report('Tree (%d files)' % args.files, suites['tree'])
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'arguments': vars(args),
+        'suites': suites,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            if compare_reports(json.load(baseline), report, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
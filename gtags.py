@@ -1,12 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import collections
+import hashlib
+import heapq
 import itertools
-import locale
+import marshal
 import os
+import pipes
 import re
 import shlex
+import shutil
+import signal
 import subprocess
+import threading
+import time
 
+import gtagsdb
+import timing
 from utils import *
 
 GLOBAL_VERSION_RE = re.compile(r'^global - GNU GLOBAL (?P<version>[\d\.]+)$')
@@ -23,6 +34,52 @@ GLOBAL_NEW_PARSER_ARRIVAL_VERSION = '5.8.2'
 # for details.
 GLOBAL_GSYMS_REMOVAL_VERSION = '5.9'
 
+# Above this number of changed files a single incremental update
+# (gtags -i) is cheaper than updating the files one by one.
+INCREMENTAL_UPDATE_THRESHOLD = 20
+
+# Sub-databases of a sharded rebuild live in numbered directories here.
+SHARDS_DIRECTORY = '.gtags-shards'
+
+# Sizes and mtimes of the files indexed by the last rebuild.
+MANIFEST_FILE = '.gtags-manifest'
+
+# A rebuild or bulk update writes a new database here; the current one
+# is replaced only when gtags has finished successfully.
+BUILD_DIRECTORY = '.gtags-build'
+
+DATABASE_FILES = ('GTAGS', 'GRTAGS', 'GPATH', 'GSYMS')
+
+# gtags -v reports every file it parses: ' [12/345] extracting tags of
+# ./path', without the total in versions before 6.
+GTAGS_PROGRESS_RE = re.compile(
+    r'^\s*\[(?P<done>\d+)(?:/(?P<total>\d+))?\]\s+'
+    r'extracting tags of\s+(?P<path>.+?)\s*$')
+
+# ionice(1) arguments of the I/O scheduling classes a rebuild may use.
+IONICE_CLASSES = {
+    'best-effort': ['-c', '2', '-n', '7'],
+    'idle': ['-c', '3'],
+}
+
+# Windows process priority classes.
+BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+IDLE_PRIORITY_CLASS = 0x40
+
+# Suffixes of the languages gtags parses with its built-in parsers.
+# Used to list source files when the root has no gtags.files.
+SOURCE_SUFFIXES = frozenset((
+    '.c', '.h', '.y', '.s', '.S', '.java', '.c++', '.cc', '.hh', '.cpp',
+    '.cxx', '.hxx', '.hpp', '.C', '.H', '.php', '.php3', '.phtml',
+))
+
+# Patterns the direct database reader can answer: plain symbol names.
+SYMBOL_NAME_RE = re.compile(r'^[A-Za-z_$][\w$]*$')
+
+# Longest combined pattern of TagFile.match_many; cmd.exe limits
+# command lines to 8191 characters.
+BATCH_PATTERN_LENGTH = 4000 if is_windows() else 64 * 1024
+
 TAGS_RE = re.compile(
     r'^'
     r'(?P<path>(\w:)?[^:]+):'
@@ -31,6 +88,132 @@ TAGS_RE = re.compile(
     r'$', re.MULTILINE
 )
 
+# global --result ctags: name, path and line number, without the line
+# itself, so global does not have to read the source files.
+CTAGS_RE = re.compile(
+    r'^(?P<name>[^\t]+)\t'
+    r'(?P<path>[^\t]+)\t'
+    r'(?P<linenum>\d+)\r?'
+    r'$', re.MULTILINE
+)
+
+
+class LineCache(object):
+    """Shared cache of source line offsets used to fill in lazy contexts.
+
+    Keeps the line offsets of recently used files, so showing lines
+    costs a single read. Files are open only for the duration of a call
+    and are indexed again when their size or mtime changes. Mappings
+    kept open would crash the editor on access once a file is truncated
+    and would keep files from being replaced on Windows.
+    """
+
+    def __init__(self, max_files=256):
+        self.max_files = max_files
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _index(self, path, source):
+        """Return (signature, size, line offsets) of an open file."""
+        stat = os.fstat(source.fileno())
+        signature = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            entry = self.files.pop(path, None)
+        if entry is None or entry[0] != signature:
+            data = source.read()
+            offsets = [0]
+            find = data.find
+            offset = find('\n')
+            while offset != -1:
+                offsets.append(offset + 1)
+                offset = find('\n', offset + 1)
+            entry = (signature, len(data), offsets)
+        with self.lock:
+            self.files[path] = entry
+            while len(self.files) > self.max_files:
+                self.files.popitem(last=False)
+        return entry
+
+    def lines(self, path, linenums):
+        """Return lines of a file without line breaks, '' for missing ones."""
+        try:
+            with open(path, 'rb') as source:
+                _, size, offsets = self._index(path, source)
+                spans = []
+                for linenum in linenums:
+                    if 0 < linenum <= len(offsets):
+                        spans.append((offsets[linenum - 1],
+                            offsets[linenum] if linenum < len(offsets)
+                            else size))
+                    else:
+                        spans.append((0, 0))
+                used = [span for span in spans if span[1] > span[0]]
+                if not used:
+                    return [''] * len(linenums)
+                first = min(start for start, _ in used)
+                last = max(end for _, end in used)
+                source.seek(first)
+                data = source.read(last - first)
+        except (IOError, OSError):
+            return [''] * len(linenums)
+        return [data[start - first:end - first].rstrip('\r\n')
+                if end > start else '' for start, end in spans]
+
+    def line(self, path, linenum):
+        """Return a line of a file without the line break, or ''."""
+        return self.lines(path, [linenum])[0]
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+
+
+LINE_CACHE = LineCache()
+
+
+class Tag(tuple):
+    """A single global result: (path, linenum, context).
+
+    Line numbers are parsed once. Item access by field name is kept
+    for code written against the former dict results. A context of
+    None is read from the source file when it is first asked for.
+    """
+
+    __slots__ = ()
+    FIELDS = ('path', 'linenum', 'context')
+
+    def __new__(cls, path, linenum, context):
+        return tuple.__new__(cls, (path, linenum, context))
+
+    # Fields are read with tuple.__getitem__ directly: anything that goes
+    # through item access, operator.itemgetter included, would call the
+    # __getitem__ override below and be several times slower.
+    path = property(lambda self, _get=tuple.__getitem__: _get(self, 0))
+    linenum = property(lambda self, _get=tuple.__getitem__: _get(self, 1))
+
+    @property
+    def context(self):
+        context = tuple.__getitem__(self, 2)
+        if context is None:
+            return LINE_CACHE.line(self.path, self.linenum)
+        return context
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self.FIELDS:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.FIELDS else default
+
+    def __repr__(self):
+        return 'Tag(path=%r, linenum=%r, context=%r)' % self
+
 
 class GlobalVersion(object):
     def __init__(self, version_string):
@@ -54,45 +237,898 @@ class GlobalVersion(object):
         return self.string
 
 
-def find_tags_root(current, previous=None):
+class GlobalCapabilities(object):
+    def __init__(self, version):
+        self.version = version
+        self.single_update = self._since(GLOBAL_SINGLE_UPDATE_ARRIVAL_VERSION)
+        self.new_parser = self._since(GLOBAL_NEW_PARSER_ARRIVAL_VERSION)
+        self.gsyms_removed = self._since(GLOBAL_GSYMS_REMOVAL_VERSION)
+
+    def _since(self, version):
+        return self.version is not None and self.version >= version
+
+
+_capabilities = {}
+_capabilities_lock = threading.Lock()
+
+
+def binaries_signature(search_path):
+    signature = []
+    for name in ('global', 'gtags'):
+        path = find_executable(name, search_path)
+        try:
+            mtime = os.path.getmtime(path) if path else None
+        except OSError:
+            mtime = None
+        signature.append((path, mtime))
+    return tuple(signature)
+
+
+def global_capabilities(tags):
+    """Return capabilities of the GNU GLOBAL installation used by tags.
+
+    Detection runs once per global/gtags binary and is repeated only
+    if one of them is replaced.
+    """
+    key = binaries_signature(tags.subprocess.default_kwargs['env']['PATH'])
+    with _capabilities_lock:
+        capabilities = _capabilities.get(key)
+    if capabilities is None:
+        capabilities = GlobalCapabilities(tags.version())
+        with _capabilities_lock:
+            _capabilities[key] = capabilities
+    return capabilities
+
+
+_tags_roots = {}
+_tags_roots_lock = threading.Lock()
+
+# Seconds between checks for a GTAGS created below a cached tags root.
+# Rebuilds from the editor clear the cache at once.
+TAGS_ROOT_RECHECK_INTERVAL = 5.0
+
+
+def gtags_mtime(directory):
+    try:
+        return os.stat(os.path.join(directory, 'GTAGS')).st_mtime
+    except OSError:
+        return None
+
+
+def resolve_tags_root(directory):
+    """Return (root, GTAGS mtime, directories visited) for a directory."""
+    visited = []
+    previous = None
+    while directory != previous:
+        visited.append(directory)
+        mtime = gtags_mtime(directory)
+        if mtime is not None:
+            return directory, mtime, visited
+        previous, directory = directory, os.path.dirname(directory)
+    return None, None, visited
+
+
+def find_tags_root(current):
+    """Return the closest directory containing GTAGS or None.
+
+    Results are cached per directory and are revalidated by the
+    mtime of the GTAGS file found, so a rebuild or removal of the tags
+    database is picked up automatically. A GTAGS created in one of the
+    directories below the cached root is noticed within
+    TAGS_ROOT_RECHECK_INTERVAL seconds.
+    """
+    with timing.phase('find_tags_root'):
+        return _find_tags_root(current)
+
+
+def _find_tags_root(current):
     current = os.path.normpath(current)
-    if not os.path.isdir(current):
-        return find_tags_root(os.path.dirname(current))
+    while not os.path.isdir(current) and current != os.path.dirname(current):
+        current = os.path.dirname(current)
+
+    with _tags_roots_lock:
+        cached = _tags_roots.get(current)
+    if cached is not None:
+        root, mtime, below, checked = cached
+        if gtags_mtime(root) == mtime:
+            now = time.time()
+            if not below or now - checked < TAGS_ROOT_RECHECK_INTERVAL:
+                return root
+            # A database created in a directory between this one and
+            # the cached root shadows it.
+            if all(gtags_mtime(directory) is None for directory in below):
+                with _tags_roots_lock:
+                    _tags_roots[current] = (root, mtime, below, now)
+                return root
+
+    root, mtime, visited = resolve_tags_root(current)
+    # Missing roots are not cached: GTAGS may be created at any moment.
+    if root is not None:
+        now = time.time()
+        with _tags_roots_lock:
+            for i, directory in enumerate(visited):
+                _tags_roots[directory] = (root, mtime, visited[i:-1], now)
+    return root
+
+
+def clear_tags_root_cache():
+    with _tags_roots_lock:
+        _tags_roots.clear()
+
+
+def create_environ(root, extra_paths, dbpath=None):
+    environ = {
+        'PATH': os.environ['PATH'],
+        'GTAGSROOT': prepare_path_for_env(root),
+        'GTAGSLIBPATH': os.pathsep.join(
+            prepare_path_for_env(path) for path in extra_paths),
+    }
+    if dbpath is not None:
+        environ['GTAGSDBPATH'] = prepare_path_for_env(dbpath)
+    return environ
+
+
+def list_source_files(root):
+    """Return files gtags would index, relative to root.
+
+    gtags.files in the root is used when present, like gtags does.
+    """
+    listing = os.path.join(root, 'gtags.files')
+    if os.path.isfile(listing):
+        with open(listing) as listing_file:
+            return [line.strip() for line in listing_file if line.strip()]
+
+    result = []
+    for directory, directories, files in os.walk(root):
+        directories[:] = sorted(
+            name for name in directories if not name.startswith('.'))
+        for name in sorted(files):
+            if os.path.splitext(name)[1] in SOURCE_SUFFIXES:
+                result.append(use_forward_slashes(os.path.relpath(
+                    os.path.join(directory, name), root)))
+    return result
+
+
+def split_files(root, files, count):
+    """Split files into count groups of roughly equal total size."""
+    def size(path):
+        try:
+            return os.path.getsize(os.path.join(root, path))
+        except OSError:
+            return 0
+
+    heap = [(0, index, []) for index in range(count)]
+    for path in sorted(files, key=size, reverse=True):
+        total, index, group = heapq.heappop(heap)
+        group.append(path)
+        heapq.heappush(heap, (total + size(path), index, group))
+    return [sorted(group) for _, _, group in sorted(heap, key=lambda i: i[1])]
+
+
+def shard_paths(root):
+    """Return database directories of a sharded rebuild besides the root."""
+    directory = os.path.join(root, SHARDS_DIRECTORY)
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.isdigit()]
+    return [os.path.join(directory, name)
+            for name in sorted(names, key=int)
+            if os.path.isfile(os.path.join(directory, name, 'GTAGS'))]
 
-    parent = os.path.dirname(current)
-    if parent == previous:
+
+def read_shard_files(path):
+    try:
+        with open(os.path.join(path, 'files')) as listing_file:
+            return set(line.strip() for line in listing_file)
+    except IOError:
+        return set()
+
+
+class BuildProgress(object):
+    """Files parsed by running gtags processes, from their -v output.
+
+    `total` is used until every one of the `sources` processes has
+    reported its own total.
+    """
+
+    def __init__(self, callback=None, total=None, sources=1):
+        self.callback = callback
+        self.hint = total
+        self.sources = sources
+        self.counts = {}
+        self.totals = {}
+        self.path = None
+        self.started = time.time()
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    @property
+    def total(self):
+        if len(self.totals) == self.sources:
+            return sum(self.totals.values())
+        return self.hint
+
+    def feed(self, line, source=0):
+        """Account for a line of output; return whether it was progress."""
+        match = GTAGS_PROGRESS_RE.match(line)
+        if match is None:
+            return False
+        self.counts[source] = int(match.group('done'))
+        if match.group('total'):
+            self.totals[source] = int(match.group('total'))
+        self.path = match.group('path')
+        if self.callback is not None:
+            self.callback(self)
+        return True
+
+    def rate(self):
+        """Return parsed files per second or None."""
+        elapsed = time.time() - self.started
+        if not self.done or elapsed <= 0:
+            return None
+        return self.done / elapsed
+
+    def eta(self):
+        """Return the estimated number of seconds left or None."""
+        rate = self.rate()
+        if not rate or not self.total:
+            return None
+        return max(0, self.total - self.done) / rate
+
+    def describe(self):
+        if self.total:
+            text = '%d/%d files' % (self.done, self.total)
+        else:
+            text = '%d files' % self.done
+        rate = self.rate()
+        if rate is not None:
+            text += ', %.0f files/s' % rate
+        eta = self.eta()
+        if eta is not None:
+            text += ', ETA %d:%02d' % divmod(int(eta + 0.5), 60)
+        return text
+
+
+def lowered_priority(command, search_path, nice=0, ionice=None):
+    """Return command and Popen arguments running it at a lower priority.
+
+    nice is a niceness increment applied with nice(1), ionice a key of
+    IONICE_CLASSES applied with ionice(1), each where it is installed.
+    No preexec_fn is used: running Python code between fork and exec
+    can deadlock a threaded process. On Windows a positive nice selects
+    a below normal priority class and 19 the idle one.
+    """
+    kwargs = {}
+    if is_windows():
+        if nice >= 19:
+            kwargs['creationflags'] = IDLE_PRIORITY_CLASS
+        elif nice > 0:
+            kwargs['creationflags'] = BELOW_NORMAL_PRIORITY_CLASS
+        return command, kwargs
+    if ionice in IONICE_CLASSES:
+        path = find_executable('ionice', search_path)
+        if path is not None:
+            command = [path] + IONICE_CLASSES[ionice] + list(command)
+    if nice > 0:
+        path = find_executable('nice', search_path)
+        if path is not None:
+            command = [path, '-n', str(nice)] + list(command)
+    return command, kwargs
+
+
+def replace_database(source, target):
+    """Move the database files of directory source into target."""
+    for name in DATABASE_FILES:
+        path = os.path.join(target, name)
+        new_path = os.path.join(source, name)
+        if os.path.exists(new_path):
+            if is_windows() and os.path.exists(path):
+                os.remove(path)
+            os.rename(new_path, path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+# Shells kept per tags root; further concurrent queries spawn global.
+QUERY_WORKERS_PER_ROOT = 2
+
+
+class QueryWorker(object):
+    """Long-lived shell which runs global queries for a single tags root.
+
+    GNU GLOBAL has no server mode, so every query is still a separate
+    global process, but it is forked from a tiny shell with a prepared
+    environment instead of from the editor itself. A worker runs one
+    query at a time and is handed out by a QueryWorkerPool.
+    """
+
+    MARKER = '__gtags_query_done__'
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.process = None
+        self.interrupted = False
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.close()
+        # The shell leads its own process group, so that interrupt()
+        # kills the running query together with it.
+        with open(os.devnull, 'w') as devnull:
+            self.process = subprocess.Popen(['/bin/sh'], env=self.environ,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull, preexec_fn=os.setsid)
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+        self.process = None
+
+    def _run(self, command):
+        if not self.is_alive():
+            self.start()
+        self.process.stdin.write('%s 2>/dev/null; echo "%s $?"\n' % (
+            ' '.join(pipes.quote(arg) for arg in command_arguments(command)),
+            self.MARKER))
+        self.process.stdin.flush()
+
+        lines = []
+        for line in iter(self.process.stdout.readline, ''):
+            if line.startswith(self.MARKER):
+                return ''.join(lines)
+            lines.append(line)
+        raise IOError('Query worker exited unexpectedly')
+
+    def query(self, command):
+        """Return stdout of command or None if the worker is unusable."""
+        self.interrupted = False
+        # Restart the worker once if it has crashed since the last query.
+        for _ in range(2):
+            try:
+                return self._run(command)
+            except (IOError, OSError):
+                self.close()
+                if self.interrupted:
+                    break
+        return None
+
+    def interrupt(self):
+        """Kill the running query; the worker restarts on the next one."""
+        self.interrupted = True
+        process = self.process
+        if process is not None and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+class QueryWorkerPool(object):
+    """Up to `size` query workers of a tags root, one per running query.
+
+    Queries never wait for each other: acquire() returns None when
+    every worker is busy and the caller spawns global itself.
+    """
+
+    def __init__(self, environ, size=QUERY_WORKERS_PER_ROOT):
+        self.environ = environ
+        self.size = size
+        self.idle = []
+        self.count = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.closed:
+                return None
+            if self.idle:
+                return self.idle.pop()
+            if self.count < self.size:
+                self.count += 1
+                return QueryWorker(self.environ)
+        return None
+
+    def release(self, worker):
+        with self.lock:
+            if not self.closed:
+                self.idle.append(worker)
+                return
+        worker.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            worker.close()
+
+
+_query_workers = {}
+_query_workers_lock = threading.Lock()
+
+
+def query_worker(root, extra_paths):
+    """Return the QueryWorkerPool of a root, None where it is unsupported."""
+    if is_windows():
         return None
+    key = (os.path.normpath(root), tuple(extra_paths))
+    with _query_workers_lock:
+        if key not in _query_workers:
+            _query_workers[key] = QueryWorkerPool(
+                create_environ(root, extra_paths))
+        return _query_workers[key]
+
+
+def shutdown_query_workers():
+    with _query_workers_lock:
+        for worker in _query_workers.values():
+            worker.close()
+        _query_workers.clear()
+
+
+class SymbolCache(object):
+    """On-disk copy of all symbols of a tags root.
+
+    The cache is valid while the size and mtime of GTAGS and GPATH
+    are the same as when it was stored.
+    """
+
+    FORMAT = 1
+    DATABASE_FILES = ('GTAGS', 'GPATH')
+
+    def __init__(self, directory, root):
+        self.root = root
+        key = os.path.normcase(os.path.abspath(root))
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        self.path = os.path.join(directory,
+            hashlib.md5(key).hexdigest() + '.symbols')
+
+    def signature(self):
+        signature = []
+        for name in self.DATABASE_FILES:
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                return None
+            signature.append((stat.st_size, stat.st_mtime))
+        return tuple(signature)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        """Return cached symbols or None if the cache is missing or stale."""
+        try:
+            with open(self.path, 'rb') as cache_file:
+                format, signature, data = marshal.load(cache_file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if format != self.FORMAT or signature != self.signature():
+            return None
+        return data.split('\n') if data else []
+
+    def store(self, symbols, signature=None):
+        if signature is None:
+            signature = self.signature()
+        if signature is None:
+            return False
+        directory = os.path.dirname(self.path)
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_path, 'wb') as cache_file:
+                marshal.dump((self.FORMAT, signature, '\n'.join(symbols)),
+                    cache_file)
+            if is_windows() and os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            print 'Cannot store symbol cache %s: %s' % (self.path, e)
+            return False
+        return True
+
+
+class FileManifest(object):
+    """Sizes and mtimes of the source files as of the last indexing."""
+
+    FORMAT = 1
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, MANIFEST_FILE)
+
+    def scan(self):
+        files = {}
+        for path in list_source_files(self.root):
+            try:
+                stat = os.stat(os.path.join(self.root, path))
+            except OSError:
+                continue
+            files[path] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as manifest_file:
+                format, files = marshal.load(manifest_file)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        return files if format == self.FORMAT else None
+
+    def store(self, files):
+        try:
+            with open(self.path, 'wb') as manifest_file:
+                marshal.dump((self.FORMAT, files), manifest_file)
+        except IOError as e:
+            print 'Cannot store manifest %s: %s' % (self.path, e)
+
+    @staticmethod
+    def changes(old, new):
+        """Return sorted paths added, removed or modified between scans."""
+        changed = set(old) ^ set(new)
+        changed.update(path for path in set(old) & set(new)
+                       if old[path] != new[path])
+        return sorted(changed)
+
+
+class QueryCache(object):
+    """Bounded LRU cache of match() results shared by all tag files.
+
+    Entries are dropped when GTAGS or GRTAGS of their root change.
+    Sizes are estimated, so `budget` is an approximate number of bytes.
+    """
 
-    if 'GTAGS' in os.listdir(current):
-        return current
+    DATABASE_FILES = ('GTAGS', 'GRTAGS')
 
-    return find_tags_root(parent, current)
+    def __init__(self, budget=32 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def signature(self, root):
+        signature = []
+        for name in self.DATABASE_FILES:
+            try:
+                signature.append(
+                    os.path.getmtime(os.path.join(root, name)))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def estimate_size(self, tags):
+        # Lazy contexts are not loaded just to measure them.
+        return 64 + sum(120 + len(context or '')
+                        for _, _, context in tags)
+
+    def get(self, key):
+        signature = self.signature(key[0])
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != signature:
+                if entry is not None:
+                    self.size -= entry[2]
+                self.misses += 1
+                return None, signature
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1], signature
+
+    def put(self, key, tags, signature):
+        size = self.estimate_size(tags)
+        if size > self.budget:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+            self.entries[key] = (signature, tags, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, root=None):
+        with self.lock:
+            for key in list(self.entries):
+                if root is None or key[0] == root:
+                    self.size -= self.entries.pop(key)[2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class QueryStream(object):
+    """Iterates over parsed stdout lines of a process as they arrive.
+
+    With a timeout the process is killed if it has not finished that
+    many seconds after the stream is first read, and the stream is
+    flagged as timed out. The clock starts at the first read rather
+    than at spawn: streams chained behind others wait with full pipes.
+    """
+
+    cached = False
+
+    def __init__(self, process, parse, timeout=None):
+        self.process = process
+        self.parse = parse
+        self.timeout = timeout
+        self.timer = None
+        self.cancelled = False
+        self.timed_out = False
+
+    def __iter__(self):
+        if self.timeout is not None:
+            self.timer = threading.Timer(self.timeout, self._time_out)
+            self.timer.start()
+        try:
+            for line in iter(self.process.stdout.readline, ''):
+                if self.timed_out and not line.endswith('\n'):
+                    # Cut off by the timer.
+                    break
+                item = self.parse(line)
+                if item is not None:
+                    yield item
+        finally:
+            self.close()
+
+    def _time_out(self):
+        self.timed_out = True
+        kill_process(self.process)
+
+    def cancel(self):
+        self.cancelled = True
+        self.close()
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.process.poll() is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.wait()
+
+
+def command_arguments(command):
+    """Return command as a list of byte strings.
+
+    String commands are split like a shell would; unicode arguments,
+    such as file names, are encoded as UTF-8.
+    """
+    if isinstance(command, basestring):
+        return shlex.split(command.encode('utf-8'))
+    return [arg.encode('utf-8') if isinstance(arg, unicode) else arg
+            for arg in command]
+
+
+def kill_process(process):
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+
+class ProcessGroup(object):
+    """Running queries of a TagFile which can be cancelled together.
+
+    Once cancelled, queries registered later are killed immediately.
+    """
+
+    def __init__(self):
+        self.kills = {}
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def register(self, key, kill):
+        with self.lock:
+            if not self.cancelled:
+                self.kills[key] = kill
+                return
+        kill()
+
+    def unregister(self, key):
+        with self.lock:
+            self.kills.pop(key, None)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            kills, self.kills = self.kills.values(), {}
+        for kill in kills:
+            kill()
+
+
+class ChainedStream(object):
+    """Yields items of several running query streams one after another."""
+
+    cached = False
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.cancelled = False
+
+    @property
+    def timed_out(self):
+        return any(stream.timed_out for stream in self.streams)
+
+    def __iter__(self):
+        seen = set()
+        try:
+            for stream in self.streams:
+                for item in stream:
+                    if item not in seen:
+                        seen.add(item)
+                        yield item
+        finally:
+            self.close()
+
+    def cancel(self):
+        self.cancelled = True
+        self.close()
+
+    def close(self):
+        for stream in self.streams:
+            stream.close()
+
+
+class CachingStream(object):
+    """Passes on the items of a stream and hands all of them to store()
+    once the stream has been read to the end without being cancelled
+    or timing out.
+    """
+
+    cached = False
+
+    def __init__(self, stream, store):
+        self.stream = stream
+        self.store = store
+
+    @property
+    def cancelled(self):
+        return self.stream.cancelled
+
+    @property
+    def timed_out(self):
+        return self.stream.timed_out
+
+    def __iter__(self):
+        items = []
+        for item in self.stream:
+            items.append(item)
+            yield item
+        if not (self.stream.cancelled or self.stream.timed_out):
+            self.store(items)
+
+    def cancel(self):
+        self.stream.cancel()
+
+    def close(self):
+        self.stream.close()
+
+
+class CachedStream(object):
+    """A complete result, usually from the query cache, served like a
+    running stream."""
+
+    cached = True
+    timed_out = False
+
+    def __init__(self, items):
+        self.items = items
+        self.cancelled = False
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def close(self):
+        pass
 
 
 class TagSubprocess(object):
-    def __init__(self, root, extra_paths):
-        environ = {
-            'PATH': os.environ['PATH'],
-            'GTAGSROOT': prepare_path_for_env(root),
-            'GTAGSLIBPATH': os.pathsep.join(
-                prepare_path_for_env(path) for path in extra_paths),
-        }
-        self.default_kwargs = {'env': environ}
+    def __init__(self, root, extra_paths, worker=None, dbpath=None,
+                 group=None):
+        self.default_kwargs = {
+            'env': create_environ(root, extra_paths, dbpath)}
         if is_windows():
             self.default_kwargs['shell'] = True
+        self.worker = worker
+        self.group = group
+        self.timed_out = False
 
     def create(self, command, **kwargs):
-        final_kwargs = self.default_kwargs
+        final_kwargs = dict(self.default_kwargs)
         final_kwargs.update(kwargs)
 
-        if isinstance(command, basestring):
-            command = shlex.split(command.encode('utf-8'))
+        command = command_arguments(command)
 
-        return subprocess.Popen(command, **final_kwargs)
+        with timing.phase('spawn'):
+            process = subprocess.Popen(command, **final_kwargs)
+        if self.group is not None:
+            self.group.register(process, lambda: kill_process(process))
+        return process
 
-    def stdout(self, command, **kwargs):
+    def stdout(self, command, timeout=None, **kwargs):
         process = self.create(command, stdout=subprocess.PIPE, **kwargs)
-        return process.communicate()[0]
+        try:
+            return self._communicate(process, timeout)
+        finally:
+            if self.group is not None:
+                self.group.unregister(process)
+
+    def _communicate(self, process, timeout):
+        if timeout is None:
+            with timing.phase('global'):
+                return process.communicate()[0]
+
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            kill_process(process)
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            timer.cancel()
+        if killed.is_set():
+            # Killed by the timer: drop the last, possibly incomplete line.
+            self.timed_out = True
+            output = output[:output.rfind('\n') + 1]
+        return output
+
+    def query(self, command):
+        if self.group is not None and self.group.cancelled:
+            return ''
+        worker = self.worker.acquire() if self.worker is not None else None
+        if worker is not None:
+            command = command_arguments(command)
+            if self.group is not None:
+                self.group.register(worker, worker.interrupt)
+            try:
+                with timing.phase('global'):
+                    output = worker.query(command)
+            finally:
+                if self.group is not None:
+                    self.group.unregister(worker)
+                self.worker.release(worker)
+            if output is not None:
+                return output
+            if self.group is not None and self.group.cancelled:
+                return ''
+        return self.stdout(command)
+
+    def stream(self, command, parse, timeout=None, **kwargs):
+        process = self.create(command, stdout=subprocess.PIPE, **kwargs)
+        return QueryStream(process, parse, timeout)
 
     def call(self, command, **kwargs):
         process = self.create(command, stderr=subprocess.PIPE, **kwargs)
@@ -107,50 +1143,728 @@ class TagSubprocess(object):
         return success
 
 
+def read_contexts(locations, lazy=False):
+    """Return tags for (path, line number) pairs.
+
+    Contexts are read through LINE_CACHE, or later if lazy is true.
+    Lines which do not exist any more get an empty context.
+    """
+    tags = [tuple.__new__(Tag, (path, linenum, None))
+            for path, linenum in locations]
+    return tags if lazy else fill_contexts(tags)
+
+
+def fill_contexts(tags):
+    """Return tags with lazy contexts read, opening each file once."""
+    lazy = collections.OrderedDict()
+    for index, (path, linenum, context) in enumerate(tags):
+        if context is None:
+            lazy.setdefault(path, []).append((index, linenum))
+    if not lazy:
+        return tags
+    result = list(tags)
+    for path, found in lazy.items():
+        indexes, linenums = zip(*found)
+        lines = LINE_CACHE.lines(path, linenums)
+        for index, linenum, line in zip(indexes, linenums, lines):
+            result[index] = tuple.__new__(Tag, (path, linenum, line))
+    return result
+
+
 class TagFile(object):
-    def __init__(self, root, extra_paths=[]):
+    def __init__(self, root, extra_paths=[], persistent=False, cache=None,
+                 fanout_timeout=None, backend='global', lazy_context=False,
+                 nice=0, ionice=None):
         self.root = root
-        self.subprocess = TagSubprocess(root, extra_paths)
+        self.extra_paths = tuple(extra_paths)
+        self.cache = cache
+        self.fanout_timeout = fanout_timeout
+        self.backend = backend
+        self.lazy_context = lazy_context
+        worker = query_worker(root, extra_paths) if persistent else None
+        self.processes = ProcessGroup()
+        # Fan-out timeouts, counted per thread sharing this instance.
+        self.queries = threading.local()
+        self.subprocess = TagSubprocess(root, extra_paths, worker,
+                                        group=self.processes)
+        self.nice = nice
+        self.ionice = ionice
+        # Rebuilds and updates are cancelled apart from queries.
+        self.builds = ProcessGroup()
+        self.builder = TagSubprocess(root, extra_paths, group=self.builds)
 
     def version(self):
-        version_string = self.subprocess.stdout('global --version').splitlines()[0]
+        version_string = self.subprocess.query('global --version').splitlines()[0]
         match = GLOBAL_VERSION_RE.match(version_string)
         if match:
             return GlobalVersion(match.groupdict()['version'])
         return None
 
+    def databases(self):
+        """Return (root, dbpath, extra paths) of every database to query.
+
+        Sub-databases of a sharded rebuild are always queried together
+        with the root. Extra paths are queried on their own only
+        in fan-out mode, otherwise they are passed as GTAGSLIBPATH.
+        """
+        shards = [(self.root, path, ()) for path in shard_paths(self.root)]
+        if self.fanout_timeout is None:
+            return [(self.root, None, self.extra_paths)] + shards
+        return (self.project_databases() +
+                [(path, None, ()) for path in self.extra_paths])
+
+    def project_databases(self):
+        """Return databases() of the project and its shards only."""
+        return [(self.root, None, ())] + [
+            (self.root, path, ()) for path in shard_paths(self.root)]
+
+    def is_fanout_enabled(self):
+        return len(self.databases()) > 1
+
+    def fanout(self, command, databases=None):
+        """Run command on every database in parallel.
+
+        Each database is queried on its own, so results of all of them
+        are returned. A library database which does not answer within
+        fanout_timeout seconds contributes the results printed so far and
+        is counted in timeouts(); the project and its shards are waited
+        for. Outputs are returned in the order of the databases, which
+        default to databases().
+        """
+        databases = databases or self.databases()
+        outputs = [''] * len(databases)
+        timed_out = []
+
+        def run(index, database):
+            root, dbpath, extra_paths = database
+            process = TagSubprocess(root, extra_paths, dbpath=dbpath,
+                                    group=self.processes)
+            outputs[index] = process.stdout(command,
+                                            timeout=self._timeout(root))
+            if process.timed_out:
+                timed_out.append(root)
+
+        threads = [threading.Thread(target=run, args=item)
+                   for item in enumerate(databases)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if timed_out:
+            self.queries.timeouts = self.timeouts() + 1
+        return outputs
+
+    def _timeout(self, root):
+        """Return the fan-out timeout of a database: libraries only."""
+        return self.fanout_timeout if root != self.root else None
+
+    def timeouts(self):
+        """Return how many fan-out queries of the calling thread have
+        returned partial results because a library timed out."""
+        return getattr(self.queries, 'timeouts', 0)
+
+    def completed_since(self, timeouts):
+        """Return whether the queries of the calling thread since
+        timeouts() returned `timeouts` returned all results.
+
+        Partial results must not be cached or persisted.
+        """
+        return not self.processes.cancelled and self.timeouts() == timeouts
+
+    def _cache_key(self, pattern, reference):
+        # Fan-out finds library matches global hides behind project ones.
+        return (self.root, self.extra_paths, pattern, reference,
+                self.lazy_context, self.fanout_timeout is not None)
+
+    def _direct_by_prefix(self, prefix):
+        if prefix and not SYMBOL_NAME_RE.match(prefix):
+            return None
+        databases = ([(self.root, path) for path in
+                      [None] + shard_paths(self.root)] +
+                     [(path, None) for path in self.extra_paths])
+        names = set()
+        try:
+            for root, dbpath in databases:
+                names.update(gtagsdb.open_database(root, dbpath).names(prefix))
+        except gtagsdb.READ_ERRORS:
+            return None
+        return sorted(names)
+
     def by_prefix(self, prefix):
-        return self.subprocess.stdout('global -c %s' % prefix).splitlines()
+        if self.backend == 'direct':
+            result = self._direct_by_prefix(prefix)
+            if result is not None:
+                return result
 
-    def _match(self, pattern, options):
-        output = self.subprocess.stdout('global %s %s' % (options, pattern))
-        result = []
+        command = 'global -c %s' % prefix
+        if self.is_fanout_enabled():
+            return sorted(set(itertools.chain.from_iterable(
+                output.splitlines() for output in self.fanout(command))))
+        return self.subprocess.query(command).splitlines()
 
-        for match in TAGS_RE.finditer(output):
-            data = match.groupdict()
+    def _parse_fields(self, path, linenum, context, paths,
+                      new_tag=tuple.__new__):
+        # Paths repeat a lot in large result sets: convert and store
+        # each of them only once per query.
+        try:
+            path = paths[path]
+        except KeyError:
+            raw_path = path
             if is_windows():
-                # Convert from CMD encoding.
-                path = data['path'].decode(locale.getpreferredencoding())
-                # Restore original unicode path.
-                data['path'] = convert_from_83(path)
-            result.append(data)
+                with timing.phase('convert_from_83'):
+                    path = from_global_path(path)
+            paths[raw_path] = path
+        return new_tag(Tag, (path, int(linenum), context))
+
+    def _line_parser(self):
+        paths = {}
+        regex = CTAGS_RE if self.lazy_context else TAGS_RE
+
+        def parse(line):
+            match = regex.match(line)
+            if match is None:
+                return None
+            path, linenum = match.group('path', 'linenum')
+            context = None if self.lazy_context else match.group('context')
+            return self._parse_fields(path, linenum, context, paths)
+        return parse
 
+    def _match_output(self, output):
+        with timing.phase('parse'):
+            return self._parse_output(output)
+
+    def _parse_output(self, output, new_tag=tuple.__new__):
+        # No per-record Python code here: the columns are converted and
+        # the records built by map() and izip(), paths once per distinct
+        # path in _shared_paths.
+        if self.lazy_context:
+            # findall yields (name, path, linenum).
+            rows = CTAGS_RE.findall(output)
+            if not rows:
+                return []
+            _, raw_paths, linenums = zip(*rows)
+            contexts = itertools.repeat(None)
+        else:
+            # findall yields (path, drive, linenum, context).
+            rows = TAGS_RE.findall(output)
+            if not rows:
+                return []
+            raw_paths, _, linenums, contexts = zip(*rows)
+        paths = self._shared_paths(raw_paths)
+        return map(new_tag, itertools.repeat(Tag, len(rows)),
+                   itertools.izip(map(paths.__getitem__, raw_paths),
+                                  map(int, linenums), contexts))
+
+    def _shared_paths(self, paths):
+        """Map every distinct raw path to the one string to store."""
+        paths = set(paths)
+        if not is_windows():
+            return dict(itertools.izip(paths, paths))
+        with timing.phase('convert_from_83'):
+            return dict((path, from_global_path(path)) for path in paths)
+
+    def _direct_match(self, pattern, reference):
+        """Look a symbol up in the database files, without global.
+
+        Like global, libraries in extra paths are only searched when
+        the project itself has no matches, unless fanning out.
+        Returns None if the databases cannot be read directly.
+        """
+        if not SYMBOL_NAME_RE.match(pattern):
+            return None
+        project = [(self.root, path) for path in
+                   [None] + shard_paths(self.root)]
+        if (reference and len(project) > 1 and
+                not self.capabilities().gsyms_removed):
+            # References to names of other shards are in GSYMS.
+            return None
+        libraries = [(path, None) for path in self.extra_paths]
+        if self.fanout_timeout is not None:
+            project, libraries = project + libraries, []
+        try:
+            with timing.phase('read_database'):
+                locations = self._direct_locations(
+                    pattern, reference, project, libraries)
+        except gtagsdb.READ_ERRORS:
+            return None
+        with timing.phase('context'):
+            return read_contexts(sorted(set(locations)), self.lazy_context)
+
+    def _direct_locations(self, pattern, reference, project, libraries):
+        locations = []
+        defined = None
+        if reference and len(project) > 1:
+            # A shard holds references to names defined in other shards.
+            defined = any(gtagsdb.open_database(root, dbpath).defines(pattern)
+                          for root, dbpath in project)
+        for root, dbpath in project:
+            database = gtagsdb.open_database(root, dbpath)
+            locations.extend(database.lookup(pattern, reference, defined))
+        for root, dbpath in libraries:
+            if locations:
+                break
+            database = gtagsdb.open_database(root, dbpath)
+            locations.extend(database.lookup(pattern, reference))
+        return locations
+
+    def _match(self, pattern, options, reference=False):
+        if self.backend == 'direct':
+            result = self._direct_match(pattern, reference)
+            if result is not None:
+                return result
+
+        command = 'global %s %s' % (options, pattern)
+        if not self.is_fanout_enabled():
+            return self._match_output(self.subprocess.query(command))
+
+        result = []
+        seen = set()
+        for output in self.fanout(command):
+            for tag in self._match_output(output):
+                if tag not in seen:
+                    seen.add(tag)
+                    result.append(tag)
+        if reference and shard_paths(self.root):
+            locations = itertools.chain.from_iterable(
+                self._cross_shard_references(pattern).values())
+            result.extend(tag for tag in read_contexts(
+                sorted(set(locations)), self.lazy_context)
+                if tag not in seen)
+            # Like global, sorted by path.
+            result.sort()
         return result
 
+    def _cross_shard_references(self, pattern):
+        """Return references global -r leaves out in a sharded project.
+
+        global -r only lists references to names defined in the same
+        database; references to names defined in another shard are
+        listed by global -s. Those of names defined anywhere in the
+        project are returned as a dict of name -> [(path, linenum)].
+        """
+        databases = self.project_databases()
+        defined = set(name for output in self.fanout(
+            'global --result ctags -a %s' % pattern, databases)
+            for name, _, _ in CTAGS_RE.findall(output))
+        locations = collections.defaultdict(list)
+        paths = {}
+        for output in self.fanout(
+                'global --result ctags -as %s' % pattern, databases):
+            for name, path, linenum in CTAGS_RE.findall(output):
+                if name in defined:
+                    locations[name].append(self._parse_fields(
+                        path, linenum, None, paths)[:2])
+        return locations
+
+    def _match_options(self, reference):
+        result = 'ctags' if self.lazy_context else 'grep'
+        return '--result %s -a%s' % (result, 'r' if reference else '')
+
     def match(self, pattern, reference=False):
-        return self._match(pattern, '--result grep -a' +
-            ('r' if reference else ''))
+        if self.cache is None:
+            return self._match(pattern, self._match_options(reference),
+                               reference)
+
+        key = self._cache_key(pattern, reference)
+        with timing.phase('query_cache'):
+            result, signature = self.cache.get(key)
+        if result is None:
+            timeouts = self.timeouts()
+            result = self._match(pattern, self._match_options(reference),
+                                 reference)
+            # Results of killed queries are incomplete.
+            if self.completed_since(timeouts):
+                self.cache.put(key, result, signature)
+        return list(result)
+
+    def match_many(self, symbols, reference=False):
+        """Return a dict of the matches of every symbol name.
+
+        Symbols missing from the cache are looked up together: their
+        names are combined into as few regular expressions as the
+        command line allows, and global prints the name of every match
+        (--result ctags) to tell them apart. Symbols which are not
+        plain names, and without fan-out those only found in libraries
+        (global searches GTAGSLIBPATH only if the project has no match
+        at all), are looked up one by one.
+        """
+        result = {}
+        signatures = {}
+        batch = []
+        for symbol in set(symbols):
+            if self.cache is not None:
+                key = self._cache_key(symbol, reference)
+                cached, signatures[symbol] = self.cache.get(key)
+                if cached is not None:
+                    result[symbol] = list(cached)
+                    continue
+            if SYMBOL_NAME_RE.match(symbol):
+                batch.append(symbol)
+            else:
+                result[symbol] = self.match(symbol, reference)
+
+        if self.backend == 'direct':
+            for symbol in batch:
+                found = self._direct_match(symbol, reference)
+                if found is not None:
+                    result[symbol] = found
+            batch = [symbol for symbol in batch if symbol not in result]
+
+        timeouts = self.timeouts()
+        found = self._match_batch(sorted(batch), reference)
+        complete = self.completed_since(timeouts)
+        for symbol in batch:
+            if (symbol not in found and self.extra_paths and
+                    not self.is_fanout_enabled()):
+                result[symbol] = self.match(symbol, reference)
+                continue
+            result[symbol] = found.get(symbol, [])
+            if self.cache is not None and complete:
+                self.cache.put(self._cache_key(symbol, reference),
+                               result[symbol], signatures[symbol])
+        return result
+
+    def _symbol_patterns(self, symbols):
+        """Yield regular expressions matching exactly the given names."""
+        names = []
+        length = 0
+        for symbol in symbols:
+            name = symbol.replace('$', '\\$')
+            if names and length + len(name) + 1 > BATCH_PATTERN_LENGTH:
+                yield '^(%s)$' % '|'.join(names)
+                names, length = [], 0
+            names.append(name)
+            length += len(name) + 1
+        if names:
+            yield '^(%s)$' % '|'.join(names)
+
+    def _match_batch(self, symbols, reference):
+        locations = collections.defaultdict(list)
+        seen = set()
+        paths = {}
+        wanted = set(symbols)
+        for pattern in self._symbol_patterns(symbols):
+            if is_windows():
+                # Arguments go through cmd.exe, escape its metacharacters.
+                pattern = pattern.replace('^', '^^').replace('|', '^|')
+            command = ['global', '--result', 'ctags',
+                       '-a' + ('r' if reference else ''), pattern]
+            if self.is_fanout_enabled():
+                outputs = self.fanout(command)
+            else:
+                outputs = [self.subprocess.query(command)]
+            with timing.phase('parse'):
+                for output in outputs:
+                    for name, path, linenum in CTAGS_RE.findall(output):
+                        location = (name, self._parse_fields(
+                            path, linenum, None, paths)[:2])
+                        if name in wanted and location not in seen:
+                            seen.add(location)
+                            locations[name].append(location[1])
+            if reference and shard_paths(self.root):
+                others = self._cross_shard_references(pattern)
+                for name, found in others.items():
+                    for location in found:
+                        if (name in wanted and
+                                (name, location) not in seen):
+                            seen.add((name, location))
+                            locations[name].append(location)
+        with timing.phase('context'):
+            return dict((name, read_contexts(sorted(found),
+                                             self.lazy_context))
+                        for name, found in locations.items())
+
+    def stream_match(self, pattern, reference=False):
+        """Like match, but yields results while global is still running.
+
+        The returned stream can be cancelled from another thread,
+        which kills the underlying global process. A cached result is
+        replayed without running global, and a stream read to the end
+        fills the cache like match() does. Library databases which do
+        not answer within fanout_timeout are killed like in fanout();
+        the stream is then flagged as timed out and not cached.
+
+        References of a sharded project are merged from several queries
+        by match() and are returned all at once.
+        """
+        if reference and shard_paths(self.root):
+            return CachedStream(self.match(pattern, reference))
+        if self.cache is None:
+            return self._stream_match(pattern, reference)
+        key = self._cache_key(pattern, reference)
+        with timing.phase('query_cache'):
+            result, signature = self.cache.get(key)
+        if result is not None:
+            return CachedStream(list(result))
+
+        def store(items):
+            # Killed queries stop streams early.
+            if not self.processes.cancelled:
+                self.cache.put(key, items, signature)
+        return CachingStream(self._stream_match(pattern, reference), store)
+
+    def _stream_match(self, pattern, reference):
+        command = 'global %s %s' % (self._match_options(reference), pattern)
+        if not self.is_fanout_enabled():
+            return self.subprocess.stream(command, self._line_parser())
+        return ChainedStream([
+            TagSubprocess(root, extra_paths, dbpath=dbpath,
+                          group=self.processes).stream(
+                command, self._line_parser(), timeout=self._timeout(root))
+            for root, dbpath, extra_paths in self.databases()])
 
-    def rebuild(self):
-        return self.subprocess.status('gtags -v', cwd=self.root)
+    def cancel(self):
+        """Kill the running and all further queries of this instance."""
+        self.processes.cancel()
+
+    def cancel_build(self):
+        """Kill the running and all further rebuilds and bulk updates.
+
+        The database they would have replaced is kept as it was.
+        """
+        self.builds.cancel()
+
+    def invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.invalidate(self.root)
+
+    def _run_builds(self, commands, progress=None):
+        """Run gtags commands in parallel at the configured priority.
+
+        Their verbose output is fed to progress, anything else is printed
+        if a command fails. Return whether all of them succeeded.
+        """
+        search_path = self.builder.default_kwargs['env']['PATH']
+        processes = []
+        for command in commands:
+            command, kwargs = lowered_priority(command, search_path,
+                                               self.nice, self.ionice)
+            processes.append(self.builder.create(command, cwd=self.root,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs))
+        results = [None] * len(processes)
+
+        def read(index, process):
+            messages = []
+            for line in iter(process.stdout.readline, ''):
+                if progress is None or not progress.feed(line, index):
+                    messages.append(line)
+            results[index] = (process.wait(), messages)
+            self.builds.unregister(process)
+
+        threads = [threading.Thread(target=read, args=(index, process))
+                   for index, process in enumerate(processes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        success = True
+        for retcode, messages in results:
+            if retcode != 0:
+                success = False
+                if not self.builds.cancelled:
+                    print ''.join(messages)
+        return success and not self.builds.cancelled
+
+    def _build_path(self, copy=False):
+        """Return an empty BUILD_DIRECTORY, or one with a database copy."""
+        build_path = os.path.join(self.root, BUILD_DIRECTORY)
+        shutil.rmtree(build_path, ignore_errors=True)
+        os.makedirs(build_path)
+        if copy:
+            for name in DATABASE_FILES:
+                path = os.path.join(self.root, name)
+                if os.path.exists(path):
+                    # Keeps the mtime gtags -i compares sources against.
+                    shutil.copy2(path, build_path)
+        return build_path
+
+    def rebuild(self, shards=1, store_manifest=None, progress=None):
+        """Rebuild the database, splitting it into shards if asked to.
+
+        A sharded rebuild indexes groups of files in parallel processes;
+        the first group becomes the database in the root and the others
+        are sub-databases in SHARDS_DIRECTORY, queried transparently.
+        The previous database is kept until the new one is complete.
+
+        The manifest used by rebuild_changed() is refreshed if it exists
+        or if store_manifest is true. progress(BuildProgress) is called
+        for every file parsed.
+        """
+        manifest = FileManifest(self.root)
+        if store_manifest is None:
+            store_manifest = os.path.exists(manifest.path)
+        files = None
+        if store_manifest or shards > 1:
+            # Scanned beforehand: files changed during the rebuild are
+            # picked up by the next rebuild_changed().
+            files = manifest.scan()
+        try:
+            success = self._rebuild(shards, sorted(files or ()), progress)
+        finally:
+            self.invalidate_cache()
+        if success and store_manifest:
+            manifest.store(files)
+        return success
+
+    def _rebuild(self, shards, files, progress):
+        if shards > 1 and len(files) > 1:
+            groups = split_files(self.root, files, min(shards, len(files)))
+            return self._rebuild_sharded(groups, BuildProgress(
+                progress, len(files), len(groups)))
+        build_path = self._build_path()
+        try:
+            success = self._run_builds([['gtags', '-v', build_path]],
+                BuildProgress(progress, len(files) or None))
+            if success:
+                replace_database(build_path, self.root)
+                shutil.rmtree(os.path.join(self.root, SHARDS_DIRECTORY),
+                    ignore_errors=True)
+        finally:
+            shutil.rmtree(build_path, ignore_errors=True)
+        return success
+
+    def rebuild_changed(self, limit, shards=1, progress=None):
+        """Update only the files changed since the last rebuild.
+
+        Changes are found by comparing sizes and mtimes with the manifest
+        stored by the last rebuild. A full rebuild is done when there is
+        no manifest or more than `limit` files have changed.
+        """
+        manifest = FileManifest(self.root)
+        old = manifest.load()
+        if old is None:
+            return self.rebuild(shards, store_manifest=True,
+                                progress=progress)
+        new = manifest.scan()
+        changed = FileManifest.changes(old, new)
+        if len(changed) > limit:
+            return self.rebuild(shards, store_manifest=True,
+                                progress=progress)
+        success = self.update_files(
+            [os.path.join(self.root, path) for path in changed], progress)
+        if success:
+            manifest.store(new)
+        return success
+
+    def _rebuild_sharded(self, groups, progress=None):
+        build_path = os.path.join(self.root, SHARDS_DIRECTORY + '.new')
+        shutil.rmtree(build_path, ignore_errors=True)
+
+        commands = []
+        for index, group in enumerate(groups):
+            dbpath = os.path.join(build_path, str(index))
+            os.makedirs(dbpath)
+            listing = os.path.join(dbpath, 'files')
+            with open(listing, 'w') as listing_file:
+                listing_file.write('\n'.join(group) + '\n')
+            commands.append(['gtags', '-v', '-f', listing, dbpath])
+
+        if not self._run_builds(commands, progress):
+            shutil.rmtree(build_path, ignore_errors=True)
+            return False
+
+        # The previous database stays in place until all shards are built.
+        replace_database(os.path.join(build_path, '0'), self.root)
+        shards_path = os.path.join(self.root, SHARDS_DIRECTORY)
+        shutil.rmtree(shards_path, ignore_errors=True)
+        os.rename(build_path, shards_path)
+        return True
+
+    def shard_of(self, path):
+        """Return the sub-database holding path or None for the root one."""
+        relative = use_forward_slashes(os.path.relpath(path, self.root))
+        for dbpath in shard_paths(self.root):
+            if relative in read_shard_files(dbpath):
+                return dbpath
+        return None
+
+    def capabilities(self):
+        return global_capabilities(self)
 
     def is_single_update_supported(self):
-        return self.version() >= GLOBAL_SINGLE_UPDATE_ARRIVAL_VERSION
+        return self.capabilities().single_update
 
     def update_file(self, path):
         if not self.is_single_update_supported():
             return False
+        dbpath = self.shard_of(path)
         if is_windows():
             path = use_forward_slashes(path)
-        return self.subprocess.status('gtags --single-update %s' % path,
-            cwd=self.root)
+        try:
+            if dbpath is not None:
+                return self.subprocess.status(
+                    ['gtags', '--single-update', path, dbpath], cwd=self.root)
+            return self.subprocess.status('gtags --single-update %s' % path,
+                cwd=self.root)
+        finally:
+            self.invalidate_cache()
+
+    def file_symbols(self, paths):
+        """Return names of all symbols defined in the files."""
+        if not paths:
+            return set()
+        if is_windows():
+            paths = [use_forward_slashes(path) for path in paths]
+        command = ['global', '-f'] + list(paths)
+        if self.is_fanout_enabled():
+            output = ''.join(self.fanout(command))
+        else:
+            output = self.subprocess.query(command)
+        return set(line.split(None, 1)[0] for line in output.splitlines()
+                   if line.strip())
+
+    def patch_symbols(self, symbols, before, after):
+        """Return sorted symbols with definitions of updated files applied.
+
+        `before` and `after` are file_symbols() of the updated files taken
+        around the update. A symbol gone from these files is kept while it
+        is still defined somewhere else.
+        """
+        symbols = list(symbols)
+        for name in sorted(before - after):
+            if self.match(name):
+                continue
+            index = bisect.bisect_left(symbols, name)
+            if index < len(symbols) and symbols[index] == name:
+                del symbols[index]
+        for name in sorted(after - before):
+            index = bisect.bisect_left(symbols, name)
+            if index == len(symbols) or symbols[index] != name:
+                symbols.insert(index, name)
+        return symbols
+
+    def update(self, progress=None):
+        """Update changed files with gtags -i.
+
+        The update is done on a copy of the database which replaces it
+        once gtags has finished, so a cancelled update changes nothing.
+        """
+        build_path = self._build_path(copy=True)
+        try:
+            success = self._run_builds([['gtags', '-i', '-v', build_path]],
+                BuildProgress(progress))
+            if success:
+                replace_database(build_path, self.root)
+            return success
+        finally:
+            shutil.rmtree(build_path, ignore_errors=True)
+            self.invalidate_cache()
+
+    def update_files(self, paths, progress=None):
+        """Update several files with a single writer at a time.
+
+        Single file updates are not interrupted by cancel_build(),
+        which stops before the next file instead.
+        """
+        # gtags -i would pull files of the other shards into the root one.
+        if not shard_paths(self.root) and (
+                len(paths) > INCREMENTAL_UPDATE_THRESHOLD or
+                not self.is_single_update_supported()):
+            return self.update(progress)
+        success = True
+        for path in paths:
+            if self.builds.cancelled:
+                return False
+            success = self.update_file(path) and success
+        return success
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+"""Read-only access to GNU GLOBAL databases without running global(1).
+
+GTAGS, GRTAGS and GPATH are Berkeley DB 1.85 B-tree files. Keys and
+values are NUL-terminated strings:
+
+    GPATH   './path' -> file id, and file id -> './path'
+    GTAGS   tag name -> '<file id> <tag name> <line number> <line image>'
+            or, in compact format, '<file id> <tag name> <line numbers>'
+    GRTAGS  like GTAGS, always in compact format
+
+Keys starting with ' __.' hold database options.
+"""
+
+import os
+import struct
+import threading
+
+BTREE_MAGIC = 0x053162
+PAGE_HEADER_SIZE = 20
+ROOT_PAGE = 1
+INVALID_PAGE = 0
+
+P_BINTERNAL = 0x01
+P_BLEAF = 0x02
+P_TYPE = 0x1f
+
+P_BIGDATA = 0x01
+P_BIGKEY = 0x02
+
+META_PREFIX = ' __.'
+COMPACT_KEY = ' __.COMPACT'
+COMPLINE_KEY = ' __.COMPLINE'
+
+
+class DatabaseError(Exception):
+    pass
+
+
+# Errors of missing, truncated or corrupted databases.
+READ_ERRORS = (EnvironmentError, ValueError, IndexError, struct.error,
+               DatabaseError)
+
+
+class BTree(object):
+    """Berkeley DB 1.85 B-tree with duplicate keys, read page by page.
+
+    The file is only open while items() runs. A handle or mapping kept
+    open would stop gtags from replacing the file on Windows, and a
+    mapped file truncated by a rebuild faults with SIGBUS.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as db_file:
+            stat = os.fstat(db_file.fileno())
+            self.signature = (stat.st_size, stat.st_mtime)
+            header = db_file.read(PAGE_HEADER_SIZE)
+        if len(header) < PAGE_HEADER_SIZE:
+            raise DatabaseError('%s is too small' % path)
+
+        for order in '<>':
+            magic, version, page_size = struct.unpack_from(
+                order + 'III', header, 0)
+            if magic == BTREE_MAGIC:
+                break
+        else:
+            raise DatabaseError('%s is not a B-tree database' % path)
+        self.page_size = page_size
+        self.page_header = struct.Struct(order + 'IIIIHH')
+        self.index = struct.Struct(order + 'H')
+        self.internal = struct.Struct(order + 'IIB')
+        self.leaf = struct.Struct(order + 'IIB')
+        self.overflow = struct.Struct(order + 'II')
+
+    def _page(self, db_file, pgno):
+        db_file.seek(pgno * self.page_size)
+        page = db_file.read(self.page_size)
+        if len(page) < self.page_size:
+            # Truncated, for instance by a rebuild running meanwhile.
+            raise DatabaseError('%s has no page %d' % (self.path, pgno))
+        _, _, next_page, flags, lower, _ = \
+            self.page_header.unpack_from(page, 0)
+        count = (lower - PAGE_HEADER_SIZE) // 2
+        return page, next_page, flags & P_TYPE, count
+
+    def _entry_offset(self, page, index):
+        return self.index.unpack_from(page, PAGE_HEADER_SIZE + 2 * index)[0]
+
+    def _read_overflow(self, db_file, reference):
+        pgno, size = self.overflow.unpack_from(reference)
+        chunks = []
+        chunk_size = self.page_size - PAGE_HEADER_SIZE
+        while size > 0 and pgno != INVALID_PAGE:
+            page, next_page, _, _ = self._page(db_file, pgno)
+            chunks.append(page[PAGE_HEADER_SIZE:
+                               PAGE_HEADER_SIZE + min(size, chunk_size)])
+            size -= chunk_size
+            pgno = next_page
+        return ''.join(chunks)
+
+    def _internal(self, db_file, page, index):
+        offset = self._entry_offset(page, index)
+        size, pgno, flags = self.internal.unpack_from(page, offset)
+        start = offset + self.internal.size
+        key = page[start:start + size]
+        if flags & P_BIGKEY:
+            key = self._read_overflow(db_file, key)
+        return key, pgno
+
+    def _leaf(self, db_file, page, index, with_data=True):
+        offset = self._entry_offset(page, index)
+        key_size, data_size, flags = self.leaf.unpack_from(page, offset)
+        start = offset + self.leaf.size
+        key = page[start:start + key_size]
+        if flags & P_BIGKEY:
+            key = self._read_overflow(db_file, key)
+        if not with_data:
+            return key, None
+        start += key_size
+        data = page[start:start + data_size]
+        if flags & P_BIGDATA:
+            data = self._read_overflow(db_file, data)
+        return key, data
+
+    def _find_leaf(self, db_file, key):
+        """Return the leaf _page() which may hold the first entry >= key."""
+        pgno = ROOT_PAGE
+        while True:
+            page, next_page, page_type, count = self._page(db_file, pgno)
+            if page_type == P_BLEAF:
+                return page, next_page, page_type, count
+            if page_type != P_BINTERNAL:
+                raise DatabaseError('Unexpected page type %#x in %s' % (
+                    page_type, self.path))
+            # The first key of an internal page is never compared. Stop at
+            # the last separator strictly less than the key: duplicates of
+            # the key may start on the page to the left of an equal one.
+            low, high = 1, count
+            while low < high:
+                middle = (low + high) // 2
+                if self._internal(db_file, page, middle)[0] < key:
+                    low = middle + 1
+                else:
+                    high = middle
+            pgno = self._internal(db_file, page, low - 1)[1]
+
+    def items(self, start='', with_data=True):
+        """Yield (key, data) pairs with key >= start in key order."""
+        with open(self.path, 'rb') as db_file:
+            page, next_page, _, count = self._find_leaf(db_file, start)
+            low, high = 0, count
+            while low < high:
+                middle = (low + high) // 2
+                if self._leaf(db_file, page, middle, False)[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            index = low
+            while True:
+                while index < count:
+                    yield self._leaf(db_file, page, index, with_data)
+                    index += 1
+                if next_page == INVALID_PAGE:
+                    return
+                page, next_page, _, count = self._page(db_file, next_page)
+                index = 0
+
+
+def strip_nul(value):
+    # Some records carry flags after the terminating NUL.
+    return value.split('\0', 1)[0]
+
+
+class Database(object):
+    """GTAGS, GRTAGS and GPATH of one tags root opened for reading."""
+
+    def __init__(self, root, dbpath=None):
+        self.root = root
+        self.dbpath = dbpath or root
+        self.tags = BTree(os.path.join(self.dbpath, 'GTAGS'))
+        self.paths = BTree(os.path.join(self.dbpath, 'GPATH'))
+        try:
+            self.references = BTree(os.path.join(self.dbpath, 'GRTAGS'))
+        except (IOError, DatabaseError):
+            self.references = None
+        self.file_names = {}
+        self.options = {}
+
+    @property
+    def signature(self):
+        return tuple(tree and tree.signature
+                     for tree in (self.tags, self.references, self.paths))
+
+    def option(self, tree, key):
+        """Return whether an option record exists in a database."""
+        cache_key = (tree.path, key)
+        if cache_key not in self.options:
+            self.options[cache_key] = False
+            for found, _ in tree.items(key, with_data=False):
+                self.options[cache_key] = strip_nul(found) == key
+                break
+        return self.options[cache_key]
+
+    def path_of(self, file_id):
+        """Return the absolute path of a file id or None."""
+        if file_id not in self.file_names:
+            path = None
+            for key, data in self.paths.items(file_id):
+                if strip_nul(key) == file_id:
+                    path = strip_nul(data).split(' ', 1)[0]
+                break
+            if path is not None:
+                if path.startswith('./'):
+                    path = path[2:]
+                path = os.path.join(self.root, path)
+            self.file_names[file_id] = path
+        return self.file_names[file_id]
+
+    def file_id(self, path):
+        """Return the file id of a path relative to the root or None."""
+        key = './' + path.replace(os.sep, '/')
+        for found, data in self.paths.items(key):
+            if strip_nul(found) == key:
+                return strip_nul(data).split(' ', 1)[0]
+            break
+        return None
+
+    def source_files(self, prefix=''):
+        """Return paths relative to the root which start with prefix."""
+        result = []
+        start = './' + prefix
+        for key, _ in self.paths.items(start, with_data=False):
+            key = strip_nul(key)
+            if not key.startswith(start):
+                break
+            result.append(key[2:])
+        return result
+
+    def names(self, prefix=''):
+        """Return sorted unique tag names starting with prefix."""
+        result = []
+        for key, _ in self.tags.items(prefix, with_data=False):
+            key = strip_nul(key)
+            if not key.startswith(prefix):
+                break
+            if key.startswith(META_PREFIX):
+                continue
+            if not result or result[-1] != key:
+                result.append(key)
+        return result
+
+    def _line_numbers(self, field, compline):
+        numbers = []
+        last = 0
+        for item in field.split(','):
+            if not item:
+                continue
+            if compline:
+                # Differences from the previous number, '-n' continues
+                # with n consecutive lines: 10,10-3,7 is 10 20 21 22 23 30.
+                delta, _, run = item.partition('-')
+                last += int(delta)
+                numbers.append(last)
+                for _ in range(int(run or 0)):
+                    last += 1
+                    numbers.append(last)
+            else:
+                first, _, end = item.partition('-')
+                numbers.extend(range(int(first), int(end or first) + 1))
+        return numbers
+
+    def defines(self, name):
+        """Return whether GTAGS has a definition of a tag name."""
+        for key, _ in self.tags.items(name, with_data=False):
+            return strip_nul(key) == name
+        return False
+
+    def lookup(self, name, reference=False, defined=None):
+        """Return sorted (path, line number) pairs of a tag name.
+
+        Like global -r, references are only returned for names which
+        are defined: in this database unless the caller tells whether
+        the name is defined elsewhere.
+        """
+        tree = self.references if reference else self.tags
+        if defined is None:
+            defined = not reference or self.defines(name)
+        if tree is None or not defined:
+            return []
+        compline = self.option(tree, COMPLINE_KEY)
+        result = []
+        for key, data in tree.items(name):
+            if strip_nul(key) != name:
+                break
+            fields = strip_nul(data).split(' ', 3)
+            if len(fields) < 3:
+                continue
+            if fields[0].startswith('./'):
+                path = os.path.join(self.root, fields[0][2:])
+            else:
+                path = self.path_of(fields[0])
+            if path is None:
+                continue
+            if len(fields) == 4:
+                # Standard format: a single line number and its image.
+                result.append((path, int(fields[2])))
+            else:
+                result.extend((path, number) for number in
+                              self._line_numbers(fields[2], compline))
+        result.sort()
+        return result
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def database_signature(dbpath):
+    signature = []
+    for name in ('GTAGS', 'GRTAGS', 'GPATH'):
+        try:
+            stat = os.stat(os.path.join(dbpath, name))
+            signature.append((stat.st_size, stat.st_mtime))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def open_database(root, dbpath=None):
+    """Return a shared Database, reopened when its files change."""
+    key = (root, dbpath)
+    signature = database_signature(dbpath or root)
+    with _databases_lock:
+        database = _databases.get(key)
+        if database is not None and database.signature == signature:
+            return database
+        database = _databases[key] = Database(root, dbpath)
+        return database
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import functools
+import multiprocessing
 import os
+import re
 import threading
+import time
 
 import sublime
 import sublime_plugin
 
 import gtags
+import symbolindex
+import tasks
+import timing
+import watcher
 from utils import *
 
 
@@ -24,8 +32,40 @@ def main_thread(callback, *args, **kwargs):
     sublime.set_timeout(functools.partial(callback, *args, **kwargs), 0)
 
 
-def create_tags(root):
-    return gtags.TagFile(root, load_settings().get('extra_tag_paths'))
+def create_tags(root, use_worker=True):
+    """Return a TagFile of root configured by the settings.
+
+    Background lookups pass use_worker=False to leave the query shells
+    of the root to interactive commands.
+    """
+    settings = load_settings()
+    cache = None
+    if settings.get('query_cache_size'):
+        cache = dispatcher().query_cache
+        cache.budget = settings.get('query_cache_size') * 1024 * 1024
+    fanout_timeout = None
+    if settings.get('parallel_library_search'):
+        fanout_timeout = settings.get('library_search_timeout')
+    return gtags.TagFile(root, settings.get('extra_tag_paths'),
+        persistent=use_worker and settings.get('use_query_worker'),
+        cache=cache,
+        fanout_timeout=fanout_timeout,
+        backend=settings.get('query_backend', 'global'),
+        lazy_context=settings.get('lazy_context', False),
+        nice=settings.get('rebuild_nice', 0),
+        ionice=settings.get('rebuild_ionice') or None)
+
+
+def configure_timing():
+    settings = load_settings()
+    timing.configure(settings.get('timing'),
+        settings.get('timing_history'), settings.get('timing_log') or None)
+
+
+def unload_handler():
+    gtags.shutdown_query_workers()
+    if GtagsDispatcher.instance is not None:
+        GtagsDispatcher.instance.stop_watchers()
 
 
 def run_on_cwd(dir=None):
@@ -55,28 +95,33 @@ def selected_symbol(view):
     return view.substr(view.word(view.sel()[0]))
 
 
-class ThreadProgress(object):
-    def __init__(self, thread, message, success_message, error_message):
-        self.thread = thread
-        self.message = message
-        self.success_message = success_message
-        self.error_message = error_message
+class ProgressTicker(object):
+    """Single status bar indicator for all running background tasks."""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.running = False
         self.addend = 1
         self.size = 8
-        sublime.set_timeout(lambda: self.run(0), 100)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            sublime.set_timeout(lambda: self.run(0), 100)
 
     def run(self, i):
-        if not self.thread.is_alive():
-            if hasattr(self.thread, 'success') and not self.thread.success:
-                sublime.status_message(self.error_message)
-            else:
-                sublime.status_message(self.success_message)
+        active = [task for task in self.executor.active() if task.message]
+        if not active:
+            self.running = False
             return
 
+        message = active[0].message
+        if len(active) > 1:
+            message += ' (+%d more)' % (len(active) - 1)
         before = i % self.size
         after = (self.size - 1) - before
         sublime.status_message('%s [%s=%s]' % \
-            (self.message, ' ' * before, ' ' * after))
+            (message, ' ' * before, ' ' * after))
         if not before:
             self.addend = 1
         elif not after:
@@ -85,12 +130,51 @@ class ThreadProgress(object):
         sublime.set_timeout(lambda: self.run(i), 100)
 
 
+def run_in_background(func, operation=None, **kwargs):
+    """Submit func(task) to the shared executor and report its outcome.
+
+    The task is timed as `operation` if given. See tasks.Task for
+    the other accepted keyword arguments.
+    """
+    timer = timing.NULL_TIMER
+    if operation is not None:
+        timer = timing.start(operation, kwargs.get('root'))
+
+    def timed(task):
+        with timer.bind():
+            return func(task)
+
+    task = dispatcher().executor.submit(tasks.Task(timed, **kwargs))
+    task.on_done(lambda task: timer.finish())
+    task.on_done(lambda task: main_thread(report_task, task))
+    dispatcher().ticker.start()
+    return task
+
+
+def report_task(task):
+    if task.cancelled:
+        return
+    message = task.success_message if task.success else task.error_message
+    if message:
+        sublime.status_message(message)
+
+
 class GtagsDispatcher(object):
     instance = None
 
     def __init__(self):
         self.cache = {}
+        self.indexes = {}
+        self.completions = {}
         self.jumps = {}
+        self.updates = {}
+        self.query_cache = gtags.QueryCache()
+        self.watchers = {}
+        self.executor = tasks.TaskExecutor(
+            load_settings().get('background_workers'))
+        self.ticker = ProgressTicker(self.executor)
+        configure_timing()
+        load_settings().add_on_change('gtags_timing', configure_timing)
 
     def jump_history(self, root):
         root = universal_normalize(root)
@@ -98,6 +182,28 @@ class GtagsDispatcher(object):
             self.jumps[root] = JumpHistory()
         return self.jumps[root]
 
+    def update_queue(self, root):
+        root = universal_normalize(root)
+        if root not in self.updates:
+            self.updates[root] = UpdateQueue()
+        return self.updates[root]
+
+    def watch(self, root):
+        """Start watching root for changes made outside the editor."""
+        key = universal_normalize(root)
+        if key in self.watchers:
+            return
+        settings = load_settings()
+        self.watchers[key] = watcher.create_watcher(root,
+            lambda paths: main_thread(update_watched_files, root, paths),
+            settings.get('watch_interval'),
+            settings.get('watch_poll_interval'))
+
+    def stop_watchers(self):
+        for root_watcher in self.watchers.values():
+            root_watcher.stop()
+        self.watchers.clear()
+
     def store_in_cache(self, root, symbols):
         self.cache[universal_normalize(root)] = symbols
 
@@ -106,6 +212,38 @@ class GtagsDispatcher(object):
 
     def clear_cache_entry(self, root):
         self.store_in_cache(root, None)
+        self.drop_completions(root)
+
+    def symbol_index(self, root, symbols):
+        """Return the index of symbols, building it if they have changed."""
+        root = universal_normalize(root)
+        index = self.indexes.get(root)
+        if index is None or index.source is not symbols:
+            index = self.indexes[root] = symbolindex.SymbolIndex(symbols)
+        return index
+
+    def drop_symbol_index(self, root):
+        self.indexes.pop(universal_normalize(root), None)
+
+    def completion_symbols(self, root, caching):
+        """Return sorted symbols to complete from, or None.
+
+        The symbol cache is used when enabled and filled. Otherwise the
+        list fetched by load_completions() is kept, even a partial one,
+        until refresh_symbols() drops it after the database changes.
+        """
+        symbols = None
+        if caching:
+            symbols = self.load_from_cache(root)
+        if symbols is None:
+            symbols = self.completions.get(universal_normalize(root))
+        return symbols
+
+    def store_completions(self, root, symbols):
+        self.completions[universal_normalize(root)] = symbols
+
+    def drop_completions(self, root):
+        self.completions.pop(universal_normalize(root), None)
 
 
 def dispatcher():
@@ -142,6 +280,42 @@ class JumpHistory(object):
         return len(self._storage) == 0
 
 
+class GtagsShowQueryCacheStats(sublime_plugin.WindowCommand):
+    def run(self):
+        stats = dispatcher().query_cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        message = ('GTags query cache: %d hits, %d misses (%d%%), '
+                   '%d entries, %d/%d KB, %d evictions') % (
+            stats['hits'], stats['misses'],
+            100 * stats['hits'] / lookups if lookups else 0,
+            stats['entries'], stats['size'] / 1024, stats['budget'] / 1024,
+            stats['evictions'])
+        print message
+        sublime.status_message(message)
+
+
+class GtagsShowTimings(sublime_plugin.WindowCommand):
+    """Show latency percentiles of recent commands in an output panel."""
+
+    def run(self, clear=False):
+        recorder = timing.recorder()
+        if recorder is None:
+            sublime.status_message(
+                'GTags timing is disabled, set "timing" to true to enable it')
+            return
+        if clear:
+            recorder.clear()
+            sublime.status_message('GTags timings cleared')
+            return
+        text = timing.format_summary(recorder.summary()) or 'No timings yet'
+        panel = self.window.get_output_panel('gtags_timings')
+        edit = panel.begin_edit()
+        panel.erase(edit, sublime.Region(0, panel.size()))
+        panel.insert(edit, 0, text)
+        panel.end_edit(edit)
+        self.window.run_command('show_panel', {'panel': 'output.gtags_timings'})
+
+
 class GtagsJumpBack(sublime_plugin.WindowCommand):
     def run(self):
         file_name = sublime.active_window().active_view().file_name()
@@ -151,88 +325,475 @@ class GtagsJumpBack(sublime_plugin.WindowCommand):
                 dispatcher().jump_history(tags_root).jump_back()
 
 
-def gtags_jump_keyword(view, keywords, root, showpanel=False):
-    def jump(keyword):
-        dispatcher().jump_history(root).append(view)
-        position = '%s:%d:0' % (
-            os.path.normpath(keyword['path']), int(keyword['linenum']))
-        view.window().open_file(position, sublime.ENCODED_POSITION)
+def jump_to_keyword(view, keyword, root):
+    dispatcher().jump_history(root).append(view)
+    position = '%s:%d:0' % (os.path.normpath(keyword.path), keyword.linenum)
+    view.window().open_file(position, sublime.ENCODED_POSITION)
 
+
+def keyword_panel_items(keywords, root):
+    if load_settings().get('show_relative_paths'):
+        convert_path = per_directory(lambda path: os.path.relpath(path, root))
+    else:
+        convert_path = per_directory(os.path.normpath)
+    return [
+        [context.strip(), '%s:%d' % (convert_path(path), linenum)]
+        for path, linenum, context in gtags.fill_contexts(keywords)
+    ]
+
+
+def gtags_jump_keyword(view, keywords, root, showpanel=False):
     def on_select(index):
         if index != -1:
-            jump(keywords[index])
+            jump_to_keyword(view, keywords[index], root)
 
     if showpanel or len(keywords) > 1:
-        if load_settings().get('show_relative_paths'):
-            convert_path = lambda path: os.path.relpath(path, root)
-        else:
-            convert_path = os.path.normpath
-        data = [
-            [kw['context'].strip(),
-             '%s:%d' % (convert_path(kw['path']), int(kw['linenum']))]
-             for kw in keywords
-        ]
-        view.window().show_quick_panel(data, on_select)
+        with timing.phase('panel_items'):
+            items = keyword_panel_items(keywords, root)
+        with timing.phase('show_quick_panel'):
+            view.window().show_quick_panel(items, on_select)
     else:
-        jump(keywords[0])
+        jump_to_keyword(view, keywords[0], root)
+
+
+def symbol_cache(root):
+    if not load_settings().get('persistent_symbol_cache'):
+        return None
+    return gtags.SymbolCache(
+        os.path.join(sublime.packages_path(), 'User', 'GTags.cache'), root)
+
+
+# Whether symbols are cached in memory, and the SymbolCache on disk.
+SymbolCaching = collections.namedtuple('SymbolCaching', 'enabled disk')
+
 
+def symbol_caching(root):
+    """Return the SymbolCaching of root; call it on the main thread.
 
-class ShowSymbolsThread(threading.Thread):
-    def __init__(self, view, tags, root, is_caching_allowed):
-        threading.Thread.__init__(self)
+    Tasks get it as an argument instead of reading the settings and
+    the packages path on their own thread.
+    """
+    if not load_settings().get('cache_search_results'):
+        return SymbolCaching(False, None)
+    return SymbolCaching(True, symbol_cache(root))
+
+
+def load_symbols(tags, caching):
+    """Return all symbols of tags using the memory and disk caches."""
+    if not caching.enabled:
+        return tags.by_prefix('')
+    symbols = dispatcher().load_from_cache(tags.root)
+    if symbols is None:
+        cache = caching.disk
+        if cache is not None:
+            symbols = cache.load()
+        if symbols is None:
+            symbols, complete = fetch_symbols(tags, cache)
+            if not complete:
+                return symbols
+        dispatcher().store_in_cache(tags.root, symbols)
+    return symbols
+
+
+def fetch_symbols(tags, cache):
+    """Return all symbols and whether no library search timed out.
+
+    Only complete lists are stored in the disk cache.
+    """
+    signature = cache.signature() if cache is not None else None
+    timeouts = tags.timeouts()
+    symbols = tags.by_prefix('')
+    complete = tags.completed_since(timeouts)
+    if cache is not None and complete:
+        cache.store(symbols, signature)
+    return symbols, complete
+
+
+def refresh_symbols(tags, caching):
+    """Bring cached symbols up to date after the database has changed."""
+    dispatcher().drop_completions(tags.root)
+    if not caching.enabled:
+        # The search index holds the only copy of the symbols.
+        dispatcher().drop_symbol_index(tags.root)
+        return
+    cache = caching.disk
+    if (dispatcher().load_from_cache(tags.root) is None and
+            (cache is None or not cache.exists())):
+        # Nothing was cached, so nothing needs a refresh.
+        return
+    symbols, complete = fetch_symbols(tags, cache)
+    # Partial symbols are fetched again when they are next needed.
+    dispatcher().store_in_cache(tags.root, symbols if complete else None)
+
+
+def cached_symbols(tags, caching):
+    if not caching.enabled:
+        return None
+    symbols = dispatcher().load_from_cache(tags.root)
+    if symbols is None and caching.disk is not None:
+        symbols = caching.disk.load()
+    return symbols
+
+
+def build_progress(task):
+    """Return a callback showing gtags progress in the task message."""
+    message = task.message
+
+    def report(progress):
+        task.message = '%s (%s)' % (message, progress.describe())
+    return report
+
+
+def update_tags(task, tags, file_names, caching):
+    """Update files in the database keeping cached symbols up to date.
+
+    Definitions of the updated files are compared before and after the
+    update and only the difference is applied to the cached symbols.
+    """
+    task.on_cancel(tags.cancel_build)
+    symbols = cached_symbols(tags, caching)
+    if (symbols is None or
+            len(file_names) > gtags.INCREMENTAL_UPDATE_THRESHOLD):
+        success = tags.update_files(file_names, build_progress(task))
+        if success:
+            refresh_symbols(tags, caching)
+        return success
+
+    before = tags.file_symbols(file_names)
+    if not tags.update_files(file_names):
+        dispatcher().clear_cache_entry(tags.root)
+        return False
+    cache = caching.disk
+    signature = cache.signature() if cache is not None else None
+    symbols = tags.patch_symbols(symbols, before,
+        tags.file_symbols(file_names))
+    dispatcher().store_in_cache(tags.root, symbols)
+    if cache is not None:
+        cache.store(symbols, signature)
+    return True
+
+
+def load_symbol_cache(task, root, cache):
+    symbols = cache.load()
+    if symbols is not None:
+        main_thread(store_loaded_symbols, root, symbols)
+
+
+def store_loaded_symbols(root, symbols):
+    if dispatcher().load_from_cache(root) is None:
+        dispatcher().store_in_cache(root, symbols)
+
+
+class GtagsSymbolCacheLoader(sublime_plugin.EventListener):
+    """Loads the on-disk symbol cache of a root in the background."""
+
+    def on_activated(self, view):
+        settings = load_settings()
+        if not (settings.get('cache_search_results') and
+                settings.get('persistent_symbol_cache')):
+            return
+        file_name = view.file_name()
+        if file_name is None:
+            return
+        tags_root = gtags.find_tags_root(file_name)
+        if (tags_root is None or
+                dispatcher().load_from_cache(tags_root) is not None):
+            return
+        run_in_background(
+            functools.partial(load_symbol_cache, root=tags_root,
+                              cache=symbol_cache(tags_root)),
+            key=('load_symbols', tags_root))
+
+
+def find_definitions(task, view, tags, symbol):
+    task.on_cancel(tags.cancel)
+    definitions = tags.match(symbol)
+    if task.cancelled or not definitions:
+        return False
+    main_thread(show_definitions, task, view, tags, definitions)
+    return True
+
+
+def show_definitions(task, view, tags, definitions):
+    if not task.cancelled:
+        gtags_jump_keyword(view, definitions, tags.root)
+
+
+def jump_to_definition(view, tags, symbol):
+    """Look the definitions of a symbol chosen from a panel up in the
+    background, like the search commands, and jump to them."""
+    run_in_background(functools.partial(find_definitions,
+            view=view, tags=tags, symbol=symbol),
+        group='search',
+        message='Searching for "%s"' % symbol,
+        error_message='The symbol "%s" was not found' % symbol)
+
+
+def show_symbols(task, view, tags, caching):
+    symbols = load_symbols(tags, caching)
+    if not symbols or task.cancelled:
+        return False
+    timing.current().count(len(symbols))
+
+    def on_select(index):
+        if index != -1:
+            jump_to_definition(view, tags, symbols[index])
+
+    main_thread(lambda: view.window().show_quick_panel(symbols, on_select))
+
+
+class GtagsShowSymbols(sublime_plugin.TextCommand):
+    def run(self, edit):
+        @run_on_cwd()
+        def and_then(view, tags):
+            run_in_background(functools.partial(show_symbols,
+                    view=view, tags=tags,
+                    caching=symbol_caching(tags.root)),
+                key=('symbols', tags.root), root=tags.root,
+                operation='show_symbols',
+                message='Getting symbols on %s' % tags.root,
+                success_message='Symbols have successfully obtained',
+                error_message='No symbols found')
+
+
+class SymbolSearch(object):
+    """As-you-type symbol search backed by a SymbolIndex.
+
+    The best matches are shown in the status bar while typing;
+    confirming the input shows all of them in the quick panel.
+    """
+
+    def __init__(self, view, tags, index):
         self.view = view
         self.tags = tags
-        self.root = root
-        self.is_caching_allowed = is_caching_allowed
+        self.index = index
+        self.limit = load_settings().get('symbol_search_limit')
 
-    def run(self):
-        symbols = None
-        if self.is_caching_allowed:
-            symbols = dispatcher().load_from_cache(self.root)
-        if symbols is None:
-            symbols = self.tags.by_prefix('')
-        if self.is_caching_allowed:
-            dispatcher().store_in_cache(self.root, symbols)
-        self.success = len(symbols) > 0
-        if not self.success:
+    def start(self):
+        self.view.window().show_input_panel('Search symbol:', '',
+            self.on_done, self.on_change, None)
+
+    def on_change(self, text):
+        if not text:
+            return
+        matches = self.index.search(text, 6)
+        if not matches:
+            sublime.status_message('No symbols match "%s"' % text)
+            return
+        shown = ', '.join(matches[:5])
+        if len(matches) > 5:
+            shown += ', ...'
+        sublime.status_message(shown)
+
+    def on_done(self, text):
+        matches = self.index.search(text, self.limit)
+        if not matches:
+            sublime.status_message('No symbols match "%s"' % text)
             return
 
         def on_select(index):
             if index != -1:
-                definitions = self.tags.match(symbols[index])
-                gtags_jump_keyword(self.view, definitions, self.root)
+                jump_to_definition(self.view, self.tags, matches[index])
 
-        sublime.set_timeout(
-            lambda: self.view.window().show_quick_panel(symbols, on_select), 0)
+        self.view.window().show_quick_panel(matches, on_select)
 
 
-class GtagsShowSymbols(sublime_plugin.TextCommand):
+def build_symbol_index(task, tags, caching):
+    return dispatcher().symbol_index(tags.root, load_symbols(tags, caching))
+
+
+def index_symbols(task, view, tags, caching):
+    index = build_symbol_index(task, tags, caching)
+    if task.cancelled or not len(index):
+        return False
+    main_thread(SymbolSearch(view, tags, index).start)
+
+
+def load_completions(task, tags, caching):
+    dispatcher().store_completions(tags.root, load_symbols(tags, caching))
+
+
+class GtagsCompletions(sublime_plugin.EventListener):
+    """Completes project symbols by binary search in the sorted symbols.
+
+    Never runs global on the main thread: while no symbols of a root are
+    in memory they are loaded in the background. No SymbolIndex is
+    built, its trigrams are only needed by Search Symbols.
+    """
+
+    def on_query_completions(self, view, prefix, locations):
+        settings = load_settings()
+        if not (prefix and settings.get('complete_symbols')):
+            return []
+        file_name = view.file_name()
+        if file_name is None:
+            return []
+        tags_root = gtags.find_tags_root(file_name)
+        if tags_root is None:
+            return []
+
+        symbols = dispatcher().completion_symbols(tags_root,
+            settings.get('cache_search_results'))
+        if symbols is None:
+            run_in_background(functools.partial(load_completions,
+                    tags=create_tags(tags_root),
+                    caching=symbol_caching(tags_root)),
+                key=('completions', tags_root))
+            return []
+        return [('%s\tGTags' % symbol, symbol) for symbol in
+                symbolindex.prefix_symbols(symbols, prefix,
+                                           settings.get('completion_limit'))]
+
+
+IDENTIFIER_RE = re.compile(r'[A-Za-z_]\w*')
+
+
+def prefetch_symbol(task, tags, symbol, references):
+    task.on_cancel(tags.cancel)
+    tags.match(symbol)
+    if references and not task.cancelled:
+        tags.match(symbol, reference=True)
+
+
+class Prefetcher(object):
+    """Looks up symbols near the cursor once the user stops moving it.
+
+    Definitions (and references if enabled) of the symbol under the
+    cursor and of indexed symbols visible in the view go into the query
+    cache, so that jumping to them does not wait for global. Lookups run
+    at low priority, at most `prefetch_workers` at a time; moving the
+    cursor again drops the ones which have not started yet.
+    All methods are called on the main thread.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.tasks = []
+
+    def schedule(self, view):
+        self.generation += 1
+        generation = self.generation
+        sublime.set_timeout(lambda: self.prefetch(view, generation),
+            load_settings().get('prefetch_delay'))
+
+    def symbols(self, view, root):
+        symbols = [selected_symbol(view)]
+        limit = load_settings().get('prefetch_visible_symbols')
+        index = dispatcher().indexes.get(universal_normalize(root))
+        if limit and index is not None:
+            for word in IDENTIFIER_RE.findall(
+                    view.substr(view.visible_region())):
+                if len(symbols) > limit:
+                    break
+                if word not in symbols and word in index:
+                    symbols.append(word)
+        return [symbol for symbol in symbols
+                if gtags.SYMBOL_NAME_RE.match(symbol)]
+
+    def prefetch(self, view, generation):
+        if generation != self.generation or view.window() is None:
+            return
+        file_name = view.file_name()
+        if file_name is None:
+            return
+        settings = load_settings()
+        tags_root = gtags.find_tags_root(file_name)
+        if tags_root is None or not settings.get('query_cache_size'):
+            return
+
+        executor = dispatcher().executor
+        for task in self.tasks:
+            if not task.started:
+                executor.cancel(task)
+        executor.pool_limits['prefetch'] = settings.get('prefetch_workers')
+        self.tasks = [
+            run_in_background(functools.partial(prefetch_symbol,
+                    tags=create_tags(tags_root, use_worker=False),
+                    symbol=symbol,
+                    references=settings.get('prefetch_references')),
+                key=('prefetch', tags_root, symbol), pool='prefetch',
+                priority=-1)
+            for symbol in self.symbols(view, tags_root)]
+
+
+class GtagsPrefetch(sublime_plugin.EventListener):
+    prefetcher = Prefetcher()
+
+    def on_selection_modified(self, view):
+        if load_settings().get('prefetch'):
+            self.prefetcher.schedule(view)
+
+
+class GtagsSearchSymbols(sublime_plugin.TextCommand):
     def run(self, edit):
         @run_on_cwd()
         def and_then(view, tags):
-            thread = ShowSymbolsThread(view, tags, tags.root,
-                load_settings().get('cache_search_results'))
-            thread.start()
-            ThreadProgress(thread,
-                'Getting symbols on %s' % tags.root,
-                'Symbols have successfully obtained',
-                'No symbols found')
+            run_in_background(
+                functools.partial(index_symbols, view=view, tags=tags,
+                                  caching=symbol_caching(tags.root)),
+                key=('index', tags.root),
+                message='Indexing symbols on %s' % tags.root,
+                error_message='No symbols found')
+
+
+def search_finished_message(count, symbol, started):
+    return '%d results for "%s" in %d ms' % (
+        count, symbol, 1000 * (time.time() - started))
 
 
 class GtagsSearchCommand(sublime_plugin.TextCommand):
+    """Runs a query in the background and shows its results.
+
+    A newer search supersedes a running one, killing its global.
+    """
+
     def run(self, edit):
+        started = time.time()
+        timer = timing.start(self.operation)
+        with timer.bind():
+            self.search(timer, started)
+
+    def search(self, timer, started):
         @run_on_cwd()
         def and_then(view, tags):
+            timer.root = tags.root
             symbol = selected_symbol(view)
+            run_in_background(functools.partial(self.find,
+                    view=view, tags=tags, symbol=symbol, timer=timer,
+                    started=started),
+                group='search',
+                message='Searching for "%s"' % symbol)
+
+    def find(self, task, view, tags, symbol, timer, started):
+        task.on_cancel(tags.cancel)
+        task.on_cancel(timer.finish)
+        with timer.bind():
             matches = self.match(tags, symbol)
+        if task.cancelled:
+            return False
+        timer.count(len(matches))
+        main_thread(self.show, task, view, tags, symbol, matches, timer,
+                    started)
+        return bool(matches)
+
+    def show(self, task, view, tags, symbol, matches, timer, started):
+        if task.cancelled:
+            # Superseded while waiting for the main thread.
+            return
+        with timer.bind():
             if matches:
+                sublime.status_message(
+                    search_finished_message(len(matches), symbol, started))
                 gtags_jump_keyword(view, matches, tags.root,
                     showpanel=load_settings().get('show_panel_for_single_match'))
             else:
                 sublime.status_message(self.not_found() % symbol)
+        timer.finish()
 
 
 class GtagsNavigateToDefinition(GtagsSearchCommand):
+    operation = 'navigate_to_definition'
+
     def match(self, tags, symbol):
         return tags.match(symbol)
 
@@ -241,6 +802,32 @@ class GtagsNavigateToDefinition(GtagsSearchCommand):
 
 
 class GtagsFindReferences(GtagsSearchCommand):
+    operation = 'find_references'
+
+    def run(self, edit):
+        limit = load_settings().get('stream_results_limit')
+        if not limit:
+            return GtagsSearchCommand.run(self, edit)
+
+        started = time.time()
+        timer = timing.start(self.operation)
+        with timer.bind():
+            self.stream(timer, limit, started)
+
+    def stream(self, timer, limit, started):
+        @run_on_cwd()
+        def and_then(view, tags):
+            timer.root = tags.root
+            symbol = selected_symbol(view)
+            search = StreamingSearch(view, tags,
+                lambda: tags.stream_match(symbol, reference=True), limit,
+                self.not_found() % symbol, timer,
+                lambda count: search_finished_message(count, symbol, started))
+            # No key: a repeated search must replace the running one
+            # through its group rather than be merged into it.
+            run_in_background(search.run, group='search',
+                message='Searching references to "%s"' % symbol)
+
     def match(self, tags, symbol):
         return tags.match(symbol, reference=True)
 
@@ -248,13 +835,130 @@ class GtagsFindReferences(GtagsSearchCommand):
         return 'References to "%s" were not found'
 
 
-class TagsRebuildThread(threading.Thread):
-    def __init__(self, tags):
-        threading.Thread.__init__(self)
+class StreamingSearch(object):
+    """Shows the first results of a query while global is still running.
+
+    Once `limit` results have arrived they are shown in the quick panel
+    together with an entry which reopens the panel with all results.
+    Dismissing the panel or cancelling the task cancels the query.
+    query() starts it and returns its stream; it is called on the
+    task's thread, so global is never spawned on the main thread.
+    """
+
+    def __init__(self, view, tags, query, limit, not_found_message,
+                 timer=timing.NULL_TIMER, finished_message=None):
+        self.view = view
         self.tags = tags
+        self.query = query
+        self.stream = None
+        self.limit = limit
+        self.not_found_message = not_found_message
+        self.results = []
+        self.lock = threading.Lock()
+        self.panel_shown = False
+        self.show_all_when_done = False
+        self.done = False
+        self.timer = timer
+        self.finished_message = finished_message
+
+    def run(self, task):
+        task.on_cancel(self.tags.cancel)
+        with self.timer.bind():
+            self.stream = self.query()
+            task.on_cancel(self.stream.cancel)
+            with self.timer.phase('global'):
+                self.collect()
+        self.timer.count(len(self.results))
+
+        with self.lock:
+            self.done = True
+            success = bool(self.results) or self.stream.cancelled
+            if self.panel_shown and not self.show_all_when_done:
+                self.timer.finish()
+                if not task.cancelled:
+                    main_thread(self.report_finished)
+                return success
+        if task.cancelled:
+            self.timer.finish()
+        else:
+            main_thread(self.show_all)
+        return success
+
+    def collect(self):
+        # Cached results are complete at once: no partial panel.
+        limit = None if self.stream.cached else self.limit
+        for keyword in self.stream:
+            with self.lock:
+                self.results.append(keyword)
+                show_partial = (not self.panel_shown and
+                    len(self.results) == limit)
+                if show_partial:
+                    self.panel_shown = True
+            if show_partial:
+                main_thread(self.show_partial, list(self.results))
+
+    def show_partial(self, keywords):
+        items = keyword_panel_items(keywords, self.tags.root)
+        items.append(['More results...',
+            'Show all results once the search is complete'])
+
+        def on_select(index):
+            if index == -1:
+                self.stream.cancel()
+            elif index < len(keywords):
+                self.stream.cancel()
+                jump_to_keyword(self.view, keywords[index], self.tags.root)
+            else:
+                with self.lock:
+                    self.show_all_when_done = not self.done
+                if not self.show_all_when_done:
+                    self.show_all()
+
+        self.view.window().show_quick_panel(items, on_select)
+
+    def report_finished(self):
+        if self.finished_message is not None:
+            sublime.status_message(self.finished_message(len(self.results)))
+
+    def show_all(self):
+        with self.timer.bind():
+            if self.results:
+                self.report_finished()
+                gtags_jump_keyword(self.view, self.results, self.tags.root,
+                    showpanel=load_settings().get(
+                        'show_panel_for_single_match'))
+            else:
+                sublime.status_message(self.not_found_message)
+        self.timer.finish()
+
+
+def rebuild_shards():
+    shards = load_settings().get('rebuild_shards')
+    if shards == 0:
+        return multiprocessing.cpu_count()
+    return shards
 
-    def run(self):
-        self.success = self.tags.rebuild()
+
+def rebuild_tags(task, tags, caching, shards=1):
+    task.on_cancel(tags.cancel_build)
+    success = tags.rebuild(shards, progress=build_progress(task))
+    # A new database may shadow the one previously found for a folder.
+    gtags.clear_tags_root_cache()
+    clear_path_memos()
+    if success:
+        refresh_symbols(tags, caching)
+    return success
+
+
+def start_rebuild(tags):
+    return run_in_background(functools.partial(rebuild_tags,
+            tags=tags, caching=symbol_caching(tags.root),
+            shards=rebuild_shards()),
+        key=('rebuild', tags.root), writer=True,
+        root=universal_normalize(tags.root), operation='rebuild',
+        message='Rebuilding tags on %s' % tags.root,
+        success_message='Tags rebuilt successfully on %s' % tags.root,
+        error_message='Error while tags rebuilding, see console for details')
 
 
 class GtagsRebuildTags(sublime_plugin.TextCommand):
@@ -264,27 +968,136 @@ class GtagsRebuildTags(sublime_plugin.TextCommand):
 
         @run_on_cwd(dir=root)
         def and_then(view, tags):
-            thread = TagsRebuildThread(tags)
-            thread.start()
-            ThreadProgress(thread,
-                'Rebuilding tags on %s' % tags.root,
-                'Tags rebuilt successfully on %s' % tags.root,
-                'Error while tags rebuilding, see console for details')
+            start_rebuild(tags)
 
 
-class AutoUpdateThread(threading.Thread):
-    def __init__(self, tags, file_name):
-        threading.Thread.__init__(self)
-        self.tags = tags
-        self.file_name = file_name
+def rebuild_changed_tags(task, tags, limit, caching, shards=1):
+    task.on_cancel(tags.cancel_build)
+    success = tags.rebuild_changed(limit, shards, build_progress(task))
+    gtags.clear_tags_root_cache()
+    if success:
+        refresh_symbols(tags, caching)
+    return success
+
+
+class GtagsRebuildChangedTags(sublime_plugin.TextCommand):
+    def run(self, edit, **kwargs):
+        # Set root folder if used from sidebar context menu.
+        root = kwargs.get('dirs')
+
+        @run_on_cwd(dir=root)
+        def and_then(view, tags):
+            run_in_background(functools.partial(rebuild_changed_tags,
+                    tags=tags, caching=symbol_caching(tags.root),
+                    shards=rebuild_shards(),
+                    limit=load_settings().get('incremental_rebuild_limit')),
+                key=('rebuild', tags.root), writer=True,
+                root=universal_normalize(tags.root),
+                operation='rebuild_changed',
+                message='Updating changed tags on %s' % tags.root,
+                success_message='Tags updated successfully on %s' % tags.root,
+                error_message=(
+                    'Error while tags updating, see console for details'))
+
+
+class GtagsCancelRebuild(sublime_plugin.WindowCommand):
+    """Stop running and queued rebuilds and updates of tags.
+
+    gtags is killed and the database it was writing is thrown away,
+    so the previous tags stay usable.
+    """
 
     def run(self):
-        self.success = self.tags.update_file(self.file_name)
+        executor = dispatcher().executor
+        builds = [task for task in executor.active() if task.writer]
+        for task in builds:
+            executor.cancel(task)
+        if builds:
+            sublime.status_message(
+                'Tags rebuild cancelled, the previous tags are kept')
+        else:
+            sublime.status_message('No tags rebuild is running')
+
+
+def saved_key(file_name):
+    return os.path.normcase(os.path.normpath(file_name))
+
 
-        def clear_cache(tags_root):
-            dispatcher().clear_cache_entry(tags_root)
+def file_state(file_name):
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
 
-        main_thread(clear_cache, self.tags.root)
+
+class UpdateQueue(object):
+    """Coalesces saved files of a single tags root into batched updates.
+
+    Saves are debounced by `update_on_save_delay` milliseconds and at most
+    one update runs per root; files saved meanwhile wait for the next batch.
+    All methods are called on the main thread.
+    """
+
+    def __init__(self):
+        self.pending = set()
+        self.tags = None
+        self.task = None
+        self.generation = 0
+        # Size and mtime of files queued by saves, see unsaved().
+        self.saved = {}
+
+    def add_saved(self, tags, file_name):
+        self.saved[saved_key(file_name)] = file_state(file_name)
+        self.add(tags, [file_name])
+
+    def unsaved(self, file_names):
+        """Return files changed since a save queued them, or never saved.
+
+        A save is also seen by the file watcher, which must not update
+        the same file a second time.
+        """
+        result = []
+        for file_name in file_names:
+            state = self.saved.pop(saved_key(file_name), None)
+            if state is None or state != file_state(file_name):
+                result.append(file_name)
+        return result
+
+    def add(self, tags, file_names):
+        self.tags = tags
+        self.pending.update(file_names)
+        self.generation += 1
+        generation = self.generation
+        sublime.set_timeout(lambda: self.flush(generation),
+            load_settings().get('update_on_save_delay'))
+
+    def flush(self, generation=None):
+        if generation is not None and generation != self.generation:
+            # A newer save restarted the delay.
+            return
+        if not self.pending:
+            return
+        if self.task is not None and not self.task.done:
+            # Rescheduled once the running update finishes.
+            return
+
+        file_names = sorted(self.pending)
+        self.pending.clear()
+        if len(file_names) == 1:
+            subject = file_names[0]
+        else:
+            subject = '%d files' % len(file_names)
+        tags = self.tags
+        caching = symbol_caching(tags.root)
+        self.task = run_in_background(
+            lambda task: update_tags(task, tags, file_names, caching),
+            root=universal_normalize(tags.root), writer=True,
+            operation='update',
+            message='Updating tags for %s' % subject,
+            success_message='Tags updated successfully for %s' % subject,
+            error_message='Error while tags updating, see console for details')
+        self.task.on_done(lambda task: main_thread(self.flush))
 
 
 class GtagsAutoUpdate(sublime_plugin.EventListener):
@@ -297,15 +1110,40 @@ class GtagsAutoUpdate(sublime_plugin.EventListener):
         tags_root = gtags.find_tags_root(file_name)
         if tags_root is not None:
             tags = create_tags(tags_root)
-            if not tags.is_single_update_supported():
+            capabilities = tags.capabilities()
+            if not capabilities.single_update:
                 print ('Incremental single file update is not supported' + ' ' +
                        'until GNU GLOBAL v%s. You have GNU GLOBAL v%s.') % (
                     gtags.GLOBAL_SINGLE_UPDATE_ARRIVAL_VERSION,
-                    tags.version())
+                    capabilities.version)
                 return
-            thread = AutoUpdateThread(tags, file_name)
-            thread.start()
-            ThreadProgress(thread,
-                'Updating tags for %s' % file_name,
-                'Tags updated successfully for %s' % file_name,
-                'Error while tags updating, see console for details')
+            dispatcher().update_queue(tags_root).add_saved(tags, file_name)
+
+
+def update_watched_files(root, file_names):
+    """Update files changed outside the editor, see watcher.Watcher."""
+    if file_names is not None:
+        file_names = dispatcher().update_queue(root).unsaved(file_names)
+        if not file_names:
+            return
+    tags = create_tags(root)
+    threshold = load_settings().get('watch_rebuild_threshold')
+    if file_names is None or len(file_names) > threshold:
+        # A checkout or a generator touched too much to update file by file.
+        start_rebuild(tags)
+    else:
+        dispatcher().update_queue(root).add(tags, file_names)
+
+
+class GtagsFileWatcher(sublime_plugin.EventListener):
+    """Watches the tags root of every activated file if enabled."""
+
+    def on_activated(self, view):
+        if not load_settings().get('watch_files'):
+            return
+        file_name = view.file_name()
+        if file_name is None:
+            return
+        tags_root = gtags.find_tags_root(file_name)
+        if tags_root is not None:
+            dispatcher().watch(tags_root)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import array
+import bisect
+import collections
+import itertools
+import re
+
+TRIGRAMS_RE = re.compile(r'(?=(...))', re.DOTALL)
+
+
+def prefix_symbols(symbols, prefix, limit=None):
+    """Return symbols starting with prefix from a sorted symbol list."""
+    result = []
+    index = bisect.bisect_left(symbols, prefix)
+    while (index < len(symbols) and symbols[index].startswith(prefix) and
+           (limit is None or len(result) < limit)):
+        result.append(symbols[index])
+        index += 1
+    return result
+
+
+class SymbolIndex(object):
+    """In-memory index of all symbols of a tags root.
+
+    Prefix lookups use binary search over the sorted symbols.
+    Case-insensitive substring lookups of three and more characters use
+    an index of the trigrams of every symbol: candidates are taken from
+    the rarest trigram of the query and checked one by one until enough
+    are found. Shorter queries scan all symbols joined into one string.
+    """
+
+    def __init__(self, symbols):
+        self.source = symbols
+        pairs = itertools.izip(symbols, itertools.islice(symbols, 1, None))
+        if any(a > b for a, b in pairs):
+            symbols = sorted(symbols)
+        self.symbols = symbols
+
+        self.text = '\n'.join(symbols).lower()
+        self.starts = array.array('l')
+        offset = 0
+        for symbol in symbols:
+            self.starts.append(offset)
+            offset += len(symbol) + 1
+
+        self.trigrams = collections.defaultdict(lambda: array.array('i'))
+        trigrams = TRIGRAMS_RE.findall
+        for id, symbol in enumerate(symbols):
+            for trigram in set(trigrams(symbol.lower())):
+                self.trigrams[trigram].append(id)
+        self.trigrams = dict(self.trigrams)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __contains__(self, symbol):
+        index = bisect.bisect_left(self.symbols, symbol)
+        return index < len(self.symbols) and self.symbols[index] == symbol
+
+    def prefix(self, prefix, limit=None):
+        """Return symbols starting with prefix in sorted order."""
+        return prefix_symbols(self.symbols, prefix, limit)
+
+    def _scan(self, query):
+        """Yield ids of symbols containing a short lowercase query."""
+        offset = self.text.find(query)
+        while offset != -1:
+            id = bisect.bisect_right(self.starts, offset) - 1
+            yield id
+            # Continue with the next symbol.
+            offset = self.text.find(query,
+                self.starts[id] + len(self.symbols[id]) + 1)
+
+    def _candidates(self, query):
+        if len(query) < 3:
+            return self._scan(query)
+        best = ()
+        for i, trigram in enumerate(TRIGRAMS_RE.findall(query)):
+            postings = self.trigrams.get(trigram, ())
+            if i == 0 or len(postings) < len(best):
+                best = postings
+            if not best:
+                break
+        return best
+
+    def search(self, query, limit=None):
+        """Return symbols containing query, ignoring case.
+
+        Symbols starting with query (case-sensitive) come first,
+        the others follow in sorted order.
+        """
+        if not query:
+            return self.symbols[:limit]
+        result = self.prefix(query, limit)
+        if limit is not None and len(result) >= limit:
+            return result
+
+        lower = query.lower()
+        symbols = self.symbols
+        seen = set(result)
+        for id in self._candidates(lower):
+            symbol = symbols[id]
+            if lower in symbol.lower() and symbol not in seen:
+                result.append(symbol)
+                if limit is not None and len(result) >= limit:
+                    break
+        return result
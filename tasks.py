@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import traceback
+
+
+class Task(object):
+    """A unit of background work submitted to a TaskExecutor.
+
+    The function gets the task itself as the only argument, so that it
+    can check `cancelled` and register cleanup with `on_cancel`.
+    Its return value is stored in `result`; a task succeeds unless the
+    function returns False, raises or the task is cancelled.
+    """
+
+    def __init__(self, func, key=None, root=None, writer=False, group=None,
+                 pool=None, priority=0, message=None, success_message=None,
+                 error_message=None):
+        self.func = func
+        self.key = key
+        self.root = root
+        self.writer = writer
+        self.group = group
+        self.pool = pool
+        self.priority = priority
+        self.message = message
+        self.success_message = success_message
+        self.error_message = error_message
+        self.result = None
+        self.started = False
+        self.done = False
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._cancel_callbacks = []
+        self._done_callbacks = []
+
+    @property
+    def success(self):
+        return self.done and not self.cancelled and self.result is not False
+
+    def on_cancel(self, callback):
+        with self._lock:
+            if not self.cancelled:
+                self._cancel_callbacks.append(callback)
+                return
+        callback()
+
+    def on_done(self, callback):
+        with self._lock:
+            if not self.done:
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        with self._lock:
+            if self.done or self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._cancel_callbacks = self._cancel_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def run(self):
+        try:
+            if not self.cancelled:
+                self.result = self.func(self)
+        except Exception:
+            traceback.print_exc()
+            self.result = False
+        self.finish()
+
+    def finish(self):
+        with self._lock:
+            self.done = True
+            callbacks, self._done_callbacks = self._done_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class TaskExecutor(object):
+    """Bounded pool of worker threads shared by all plugin commands.
+
+    - Tasks with the same key are de-duplicated while queued or running.
+    - Writer tasks of the same root never run concurrently.
+    - Submitting a task cancels unfinished tasks of the same group.
+    - At most pool_limits[pool] tasks of a pool run concurrently.
+    - Queued tasks of higher priority start first.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.pool_limits = {}
+        self.threads = []
+        self.queue = []
+        self.running = []
+        self.condition = threading.Condition()
+
+    def submit(self, task):
+        with self.condition:
+            if task.key is not None:
+                for other in self.queue + self.running:
+                    if other.key == task.key and not other.cancelled:
+                        return other
+            stale = [other for other in self.queue + self.running
+                     if task.group is not None and other.group == task.group]
+            self.queue.append(task)
+            self._start_workers()
+            self.condition.notify()
+        for other in stale:
+            self.cancel(other)
+        return task
+
+    def cancel(self, task):
+        with self.condition:
+            queued = task in self.queue
+            if queued:
+                self.queue.remove(task)
+        task.cancel()
+        if queued:
+            task.finish()
+
+    def active(self):
+        with self.condition:
+            return list(self.running) + list(self.queue)
+
+    def _start_workers(self):
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        while len(self.threads) < min(self.workers, len(self.queue)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _next_task(self):
+        busy_roots = set(task.root for task in self.running if task.writer)
+        busy_pools = collections.Counter(task.pool for task in self.running)
+        best = None
+        for task in self.queue:
+            if task.writer and task.root in busy_roots:
+                continue
+            limit = self.pool_limits.get(task.pool)
+            if limit is not None and busy_pools[task.pool] >= limit:
+                continue
+            if best is None or task.priority > best.priority:
+                best = task
+        return best
+
+    def _work(self):
+        while True:
+            with self.condition:
+                task = self._next_task()
+                while task is None:
+                    if not self.queue:
+                        # Idle workers exit; new ones start on demand.
+                        self.threads.remove(threading.current_thread())
+                        return
+                    self.condition.wait()
+                    task = self._next_task()
+                self.queue.remove(task)
+                self.running.append(task)
+                task.started = True
+            try:
+                task.run()
+            finally:
+                with self.condition:
+                    self.running.remove(task)
+                    self.condition.notify_all()
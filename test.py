@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import errno
 import marshal
 import operator
 import os
+import random
 import shutil
+import struct
 import tempfile
+import threading
+import time
 import unittest
 
 import gtags
+import gtagsdb
+import symbolindex
+import tasks
+import timing
+import watcher
 from utils import *
 
 
@@ -69,16 +79,167 @@ class GtagsTestCase(unittest.TestCase):
             os.path.getsize(os.path.join(self.main_source_folder, filename))
             for filename in required_files))
 
+    def test_sharded_build(self):
+        tags = self.buildGtags()
+        symbols = tags.by_prefix('')
+        references = tags.match('LSQ_IteratorT', reference=True)
+
+        self.assertTrue(tags.rebuild(shards=2))
+        self.assertEquals(len(gtags.shard_paths(tags.root)), 1)
+        self.assertEquals(tags.by_prefix(''), symbols)
+        self.assertEquals(
+            sorted(tags.match('LSQ_IteratorT', reference=True)),
+            sorted(references))
+        self.assertEquals(
+            len(list(tags.stream_match('LSQ_IteratorT', reference=True))),
+            len(references))
+        # References from a shard to a name defined in another one.
+        self.assertEquals(sorted(tags.match_many(['LSQ_IteratorT'],
+            reference=True)['LSQ_IteratorT']), sorted(references))
+
+        header = os.path.join(self.main_source_folder, 'linear_sequence.h')
+        source = os.path.join(self.main_source_folder, 'doubly_linked_list.c')
+        self.assertNotEqual(tags.shard_of(header), tags.shard_of(source))
+        open(header, 'a').write('\ntypedef int LSQ_ShardedT;\n')
+        self.assertTrue(tags.update_file(header))
+        self.assertEquals(len(tags.match('LSQ_ShardedT')), 1)
+
+        self.assertTrue(tags.rebuild())
+        self.assertEquals(gtags.shard_paths(tags.root), [])
+
+    def test_rebuild_changed(self):
+        tags = gtags.TagFile(self.main_source_folder)
+        # Without a manifest everything is rebuilt.
+        self.assertTrue(tags.rebuild_changed(limit=10))
+        manifest = gtags.FileManifest(tags.root)
+        self.assertEquals(sorted(manifest.load()),
+            ['doubly_linked_list.c', 'linear_sequence.h'])
+        self.assertEquals(
+            gtags.FileManifest.changes(manifest.load(), manifest.scan()), [])
+
+        header = os.path.join(self.main_source_folder, 'linear_sequence.h')
+        open(header, 'a').write('\ntypedef int LSQ_ChangedT;\n')
+        self.assertEquals(
+            gtags.FileManifest.changes(manifest.load(), manifest.scan()),
+            ['linear_sequence.h'])
+        self.assertTrue(tags.rebuild_changed(limit=10))
+        self.assertEquals(len(tags.match('LSQ_ChangedT')), 1)
+        self.assertEquals(
+            gtags.FileManifest.changes(manifest.load(), manifest.scan()), [])
+
+    def test_build_progress(self):
+        reports = []
+        progress = gtags.BuildProgress(
+            lambda progress: reports.append(progress.path), 10, sources=2)
+        self.assertFalse(progress.feed('[Mon Jan 1] Gtags started.\n'))
+        self.assertTrue(progress.feed(' [1] extracting tags of ./a.c\n'))
+        self.assertTrue(
+            progress.feed(' [2/4] extracting tags of ./b.c\n', source=1))
+        self.assertEquals(reports, ['./a.c', './b.c'])
+        self.assertEquals((progress.done, progress.total), (3, 10))
+        self.assertTrue(progress.feed(' [2/3] extracting tags of ./c.c\n'))
+        self.assertEquals((progress.done, progress.total), (4, 7))
+        self.assertTrue(progress.eta() >= 0)
+        self.assertTrue(progress.describe().startswith('4/7 files'))
+
+    def test_cancel_build(self):
+        tags = self.buildGtags()
+        database = os.path.join(self.main_source_folder, 'GTAGS')
+        with open(database, 'rb') as database_file:
+            contents = database_file.read()
+
+        reports = []
+        tags.cancel_build()
+        self.assertFalse(tags.rebuild(progress=reports.append))
+        self.assertFalse(tags.update())
+        self.assertEquals(reports, [])
+        with open(database, 'rb') as database_file:
+            self.assertEquals(database_file.read(), contents)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.main_source_folder, gtags.BUILD_DIRECTORY)))
+
+        tags = gtags.TagFile(self.main_source_folder, nice=5, ionice='idle')
+        self.assertTrue(tags.rebuild(progress=reports.append))
+        self.assertTrue(reports)
+        self.assertEquals(len(tags.match('LSQ_IteratorT')), 1)
+
+    def test_find_tags_root(self):
+        header = os.path.join(self.main_source_folder, 'linear_sequence.h')
+        nested_folder = os.path.join(self.main_source_folder, 'nested')
+        os.mkdir(nested_folder)
+        gtags_path = os.path.join(self.test_folder, 'GTAGS')
+        open(gtags_path, 'w').close()
+
+        self.assertTrue(is_paths_equal(gtags.find_tags_root(header),
+            self.test_folder))
+        self.assertTrue(is_paths_equal(gtags.find_tags_root(nested_folder),
+            self.test_folder))
+
+        # A cache hit only checks the GTAGS of the root.
+        stats = []
+        gtags_mtime = gtags.gtags_mtime
+        gtags.gtags_mtime = lambda path: stats.append(path) or \
+            gtags_mtime(path)
+        try:
+            gtags.find_tags_root(nested_folder)
+        finally:
+            gtags.gtags_mtime = gtags_mtime
+        self.assertEquals(stats, [self.test_folder])
+
+        # A database created in a nested folder shadows the outer one
+        # once the folders below the root are checked again.
+        open(os.path.join(self.main_source_folder, 'GTAGS'), 'w').close()
+        self.assertTrue(is_paths_equal(gtags.find_tags_root(header),
+            self.test_folder))
+        interval = gtags.TAGS_ROOT_RECHECK_INTERVAL
+        gtags.TAGS_ROOT_RECHECK_INTERVAL = 0
+        try:
+            self.assertTrue(is_paths_equal(gtags.find_tags_root(header),
+                self.main_source_folder))
+            self.assertTrue(is_paths_equal(
+                gtags.find_tags_root(nested_folder), self.main_source_folder))
+        finally:
+            gtags.TAGS_ROOT_RECHECK_INTERVAL = interval
+
+        os.remove(os.path.join(self.main_source_folder, 'GTAGS'))
+        self.assertTrue(is_paths_equal(gtags.find_tags_root(nested_folder),
+            self.test_folder))
+
+        os.remove(gtags_path)
+        self.assertEquals(gtags.find_tags_root(header), None)
+
     def test_version(self):
         tags = self.buildGtags()
         self.assertTrue(isinstance(tags.version(), gtags.GlobalVersion))
 
+    def test_capabilities(self):
+        tags = self.buildGtags()
+        capabilities = tags.capabilities()
+        self.assertTrue(capabilities is tags.capabilities())
+        self.assertEquals(capabilities.version, tags.version())
+        self.assertEquals(capabilities.single_update,
+            tags.version() >= gtags.GLOBAL_SINGLE_UPDATE_ARRIVAL_VERSION)
+
     def test_get_by_prefix(self):
         tags = self.buildGtags()
         self.assertEquals(len(tags.by_prefix('')), 32)
         self.assertEquals(len(tags.by_prefix('LSQ')), 26)
         self.assertEquals(len(tags.by_prefix('foobar')), 0)
 
+    def test_symbol_cache(self):
+        tags = self.buildGtags()
+        cache_folder = os.path.join(self.test_folder, 'cache')
+        cache = gtags.SymbolCache(cache_folder, tags.root)
+        self.assertEquals(cache.load(), None)
+
+        symbols = tags.by_prefix('')
+        self.assertTrue(cache.store(symbols))
+        self.assertEquals(
+            gtags.SymbolCache(cache_folder, tags.root).load(), symbols)
+
+        open(os.path.join(tags.root, 'GTAGS'), 'a').write('\0')
+        self.assertEquals(cache.load(), None)
+
     def test_empty_match(self):
         tags = self.buildGtags()
         self.assertEquals(len(tags.match('whatever')), 0)
@@ -109,6 +270,211 @@ class GtagsTestCase(unittest.TestCase):
             path=os.path.join(self.main_source_folder, 'doubly_linked_list.c'),
             line=line)
 
+    def test_tag_record(self):
+        tags = self.buildGtags()
+        handle = tags.match('LSQ_HandleT')[0]
+        self.assertTrue(isinstance(handle, gtags.Tag))
+        self.assertEquals(handle.linenum, 11)
+        self.assertEquals(handle['linenum'], handle.linenum)
+        self.assertEquals(handle['path'], handle[0])
+        self.assertEquals(handle.get('context'), handle.context)
+        self.assertEquals(sorted(handle.keys()),
+            ['context', 'linenum', 'path'])
+        self.assertRaises(KeyError, lambda: handle['count'])
+        self.assertEquals(handle.get('count'), None)
+
+        matches = tags.match('LSQ_IteratorT', reference=True)
+        self.assertEquals(len(set(id(match.path) for match in matches)),
+            len(set(match.path for match in matches)))
+
+    def test_query_cache(self):
+        cache = gtags.QueryCache()
+        tags = self.buildGtags()
+        cached = gtags.TagFile(self.main_source_folder, cache=cache)
+        expected = tags.match('LSQ_IteratorT', reference=True)
+        for _ in range(2):
+            self.assertEquals(
+                cached.match('LSQ_IteratorT', reference=True), expected)
+        self.assertEquals(cached.match('LSQ_IteratorT'),
+            tags.match('LSQ_IteratorT'))
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses']), (1, 2))
+
+        cache.budget = cache.size - 1
+        cached.match('LSQ_HandleT')
+        self.assertTrue(cache.size <= cache.budget)
+        self.assertTrue(cache.stats()['evictions'] > 0)
+
+        cached.update_file(os.path.join(
+            self.main_source_folder, 'linear_sequence.h'))
+        self.assertEquals(cache.stats()['entries'], 0)
+
+    def test_fanout(self):
+        shutil.copy(
+            os.path.join(self.main_source_folder, 'linear_sequence.h'),
+            self.extra_source_folder)
+        gtags.TagFile(self.extra_source_folder).rebuild()
+        self.buildGtags()
+        tags = gtags.TagFile(self.main_source_folder,
+            [self.extra_source_folder], fanout_timeout=10)
+
+        matches = tags.match('LSQ_HandleT')
+        self.assertEquals(len(matches), 2)
+        self.assertTrue(is_paths_equal(matches[0]['path'],
+            os.path.join(self.main_source_folder, 'linear_sequence.h')))
+        self.assertTrue(is_paths_equal(matches[1]['path'],
+            os.path.join(self.extra_source_folder, 'linear_sequence.h')))
+        self.assertEquals(tags.by_prefix('LSQ'),
+            gtags.TagFile(self.main_source_folder).by_prefix('LSQ'))
+
+        # Only libraries are cut short, and their partial results are
+        # not cached.
+        cache = gtags.QueryCache()
+        hasty = gtags.TagFile(self.main_source_folder,
+            [self.extra_source_folder], cache=cache, fanout_timeout=0)
+        matches = hasty.match('LSQ_HandleT')
+        self.assertTrue(is_paths_equal(matches[0]['path'],
+            os.path.join(self.main_source_folder, 'linear_sequence.h')))
+        if hasty.timeouts():
+            self.assertFalse(hasty.completed_since(0))
+            self.assertEquals(cache.stats()['entries'], 0)
+        self.assertNotEqual(hasty._cache_key('LSQ_HandleT', False),
+            gtags.TagFile(self.main_source_folder, [self.extra_source_folder],
+                          cache=cache)._cache_key('LSQ_HandleT', False))
+
+    def test_direct_backend(self):
+        tags = self.buildGtags()
+        direct = gtags.TagFile(self.main_source_folder, backend='direct')
+        # malloc is used but not defined: global -r does not list it.
+        for symbol in ('LSQ_IteratorT', 'LSQ_HandleT', 'NoSuchSymbol',
+                       'malloc'):
+            for reference in (False, True):
+                self.assertEquals(direct.match(symbol, reference),
+                    tags.match(symbol, reference))
+        self.assertEquals(direct.by_prefix('LSQ'), tags.by_prefix('LSQ'))
+        # Regular expressions are passed on to global.
+        self.assertEquals(direct.match('LSQ_.*T'), tags.match('LSQ_.*T'))
+
+    def test_lazy_context(self):
+        tags = self.buildGtags()
+        lazy = gtags.TagFile(self.main_source_folder, lazy_context=True)
+        fields = lambda tags: [(t.path, t.linenum, t.context) for t in tags]
+        for reference in (False, True):
+            self.assertEquals(fields(lazy.match('LSQ_IteratorT', reference)),
+                fields(tags.match('LSQ_IteratorT', reference)))
+        # global prints CRLF line endings on Windows.
+        self.assertEquals(
+            [(t.path, t.linenum) for t in lazy._match_output(
+                'main\tmain.c\t3\r\nmain\tutil.c\t7\r\n')],
+            [('main.c', 3), ('util.c', 7)])
+
+        path = os.path.join(self.main_source_folder, 'linear_sequence.h')
+        cache = gtags.LineCache()
+        self.assertEquals(cache.line(path, 0), '')
+        with open(path, 'w') as source:
+            source.write('first\r\nsecond')
+        self.assertEquals(cache.line(path, 2), 'second')
+        with open(path, 'a') as source:
+            source.write('\nthird\n')
+        os.utime(path, (0, 0))
+        self.assertEquals(
+            [cache.line(path, line) for line in (1, 2, 3, 4)],
+            ['first', 'second', 'third', ''])
+        self.assertEquals(cache.lines(path, [3, 0, 1]),
+            ['third', '', 'first'])
+        # Truncated in place, as by a non-atomic save.
+        open(path, 'w').close()
+        os.utime(path, (0, 0))
+        self.assertEquals(cache.line(path, 2), '')
+
+        unread = gtags.read_contexts([(path, 1)], lazy=True)
+        self.assertEquals(tuple.__getitem__(unread[0], 2), None)
+        with open(path, 'w') as source:
+            source.write('line\n')
+        self.assertEquals(gtags.fill_contexts(unread)[0].context, 'line')
+
+    def test_match_many(self):
+        tags = self.buildGtags()
+        symbols = ['LSQ_IteratorT', 'LSQ_HandleT', 'NoSuchSymbol', 'LSQ_.*T']
+        fields = lambda tags: [(t.path, t.linenum, t.context) for t in tags]
+        for reference in (False, True):
+            batched = gtags.TagFile(self.main_source_folder,
+                cache=gtags.QueryCache()).match_many(symbols, reference)
+            self.assertEquals(sorted(batched), sorted(symbols))
+            for symbol in symbols:
+                self.assertEquals(fields(batched[symbol]),
+                    fields(tags.match(symbol, reference)))
+
+        cache = gtags.QueryCache()
+        cached = gtags.TagFile(self.main_source_folder, cache=cache)
+        cached.match_many(symbols)
+        self.assertEquals(cache.stats()['entries'], len(symbols))
+        self.assertEquals(cached.match_many(symbols[:2]),
+            dict((symbol, tags.match(symbol)) for symbol in symbols[:2]))
+
+    def test_cancel(self):
+        self.buildGtags()
+        for persistent in (False, True):
+            tags = gtags.TagFile(self.main_source_folder,
+                persistent=persistent, cache=gtags.QueryCache())
+            threading.Timer(0.2, tags.cancel).start()
+            started = time.time()
+            tags.subprocess.query('sleep 10')
+            self.assertTrue(time.time() - started < 5)
+            self.assertEquals(tags.match('LSQ_HandleT'), [])
+            self.assertEquals(tags.cache.stats()['entries'], 0)
+
+    def test_stream_match(self):
+        tags = self.buildGtags()
+        self.assertEquals(list(tags.stream_match('LSQ_IteratorT', True)),
+            tags.match('LSQ_IteratorT', reference=True))
+
+        stream = tags.stream_match('LSQ_IteratorT', reference=True)
+        for _ in stream:
+            stream.cancel()
+        self.assertTrue(stream.cancelled)
+        self.assertTrue(stream.process.poll() is not None)
+
+        cache = gtags.QueryCache()
+        cached = gtags.TagFile(self.main_source_folder, cache=cache)
+        stream = cached.stream_match('LSQ_IteratorT', reference=True)
+        for _ in stream:
+            stream.cancel()
+        self.assertEquals(cache.stats()['entries'], 0)
+        stream = cached.stream_match('LSQ_IteratorT', reference=True)
+        self.assertFalse(stream.cached)
+        references = list(stream)
+        stream = cached.stream_match('LSQ_IteratorT', reference=True)
+        self.assertTrue(stream.cached)
+        self.assertEquals(list(stream), references)
+        # Streams and match() share cached results.
+        self.assertEquals(cached.match('LSQ_IteratorT', reference=True),
+            references)
+        self.assertEquals(cache.stats()['entries'], 1)
+
+    def test_stream_timeout(self):
+        process = gtags.TagSubprocess(self.main_source_folder, [])
+        parse = lambda line: line.strip()
+        command = ['sh', '-c', 'echo first; printf second; exec sleep 10']
+        stream = process.stream(command, parse, timeout=0.5)
+        started = time.time()
+        self.assertEquals(list(stream), ['first'])
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(stream.timed_out)
+
+        stored = []
+        stream = gtags.CachingStream(
+            process.stream(command, parse, timeout=0.5), stored.append)
+        self.assertEquals(list(stream), ['first'])
+        self.assertTrue(stream.timed_out)
+        self.assertEquals(stored, [])
+
+        stream = gtags.ChainedStream([
+            process.stream(['echo', 'first'], parse, timeout=5),
+            process.stream(command, parse, timeout=0.5)])
+        self.assertEquals(list(stream), ['first'])
+        self.assertTrue(stream.timed_out)
+
     def test_single_update(self):
         tags = self.buildGtags()
         symbol_name = 'LSQ_IteratorT'
@@ -117,21 +483,611 @@ class GtagsTestCase(unittest.TestCase):
         open(file_name, 'a').write(symbol_name)
         tags.update_file(file_name)
         new_matches = tags.match(symbol_name, reference=True)
-        serialize = lambda matches: set(marshal.dumps(match) for match in matches)
+        serialize = lambda matches: set(
+            marshal.dumps(tuple(match)) for match in matches)
         difference = serialize(new_matches) - serialize(old_matches)
         self.assertEquals(len(difference), 1)
         self.assertTrue(list(difference)[0] not in old_matches)
 
+    def test_update_files(self):
+        tags = self.buildGtags()
+        file_names = [
+            os.path.join(self.main_source_folder, file_name)
+            for file_name in ('doubly_linked_list.c', 'linear_sequence.h')]
+        for index, file_name in enumerate(file_names):
+            open(file_name, 'a').write('\nint LSQ_Added_%d;\n' % index)
+        self.assertTrue(tags.update_files(file_names))
+        self.assertEquals(len(tags.by_prefix('LSQ_Added_')), 2)
+
+    def test_patch_symbols(self):
+        tags = self.buildGtags()
+        symbols = tags.by_prefix('')
+        file_name = os.path.join(self.main_source_folder, 'linear_sequence.h')
+        before = tags.file_symbols([file_name])
+        self.assertTrue('LSQ_HandleT' in before)
+
+        source = open(file_name).read()
+        open(file_name, 'w').write(
+            source.replace('LSQ_HandleT;', 'LSQ_RenamedT;'))
+        tags.update_file(file_name)
+        patched = tags.patch_symbols(symbols, before,
+            tags.file_symbols([file_name]))
+        self.assertEquals(patched, tags.by_prefix(''))
+        self.assertTrue('LSQ_RenamedT' in patched)
+        self.assertFalse('LSQ_HandleT' in patched)
+
+    def test_persistent_worker(self):
+        tags = self.buildGtags()
+        persistent = gtags.TagFile(self.main_source_folder, persistent=True)
+        try:
+            for _ in range(2):
+                self.assertEquals(
+                    persistent.match('LSQ_IteratorT', reference=True),
+                    tags.match('LSQ_IteratorT', reference=True))
+                self.assertEquals(persistent.by_prefix('LSQ'),
+                    tags.by_prefix('LSQ'))
+            pool = persistent.subprocess.worker
+            if pool is not None:
+                # The worker must survive a crash of its shell.
+                worker = pool.acquire()
+                worker.process.kill()
+                worker.process.wait()
+                pool.release(worker)
+                self.assertEquals(len(persistent.match('LSQ_HandleT')), 1)
+
+                # Queries finding every worker busy do not wait for them.
+                busy = [pool.acquire() for _ in range(pool.size)]
+                self.assertEquals(pool.acquire(), None)
+                self.assertEquals(len(persistent.match('LSQ_HandleT')), 1)
+                for worker in busy:
+                    pool.release(worker)
+
+            # Non-ASCII file names are written to the worker's shell.
+            file_name = os.path.join(self.main_source_folder, u'\xe9t\xe9.c')
+            with open(file_name.encode('utf-8'), 'w') as source:
+                source.write('int LSQ_Accented;\n')
+            persistent.update_file(file_name)
+            self.assertTrue('LSQ_Accented' in
+                persistent.file_symbols([file_name]))
+        finally:
+            gtags.shutdown_query_workers()
+
+
+class BTreeWriter(object):
+    """Writes small Berkeley DB 1.85 B-trees like those of GNU GLOBAL.
+
+    Pages are tiny so that a few records already need internal pages,
+    several leaves and overflow pages.
+    """
+
+    PAGE_SIZE = 512
+    HEADER = 20
+    # Keys and data longer than this go to overflow pages.
+    INLINE = 60
+
+    def __init__(self, order='<'):
+        self.order = order
+        # Page 0 holds the metadata, page 1 is the root.
+        self.pages = [None, None]
+
+    def new_page(self):
+        self.pages.append(None)
+        return len(self.pages) - 1
+
+    def write_page(self, pgno, flags, entries, next_page=0, prev_page=0):
+        body = bytearray(self.PAGE_SIZE)
+        upper = self.PAGE_SIZE
+        offsets = []
+        for entry in entries:
+            upper = (upper - len(entry)) & ~3
+            body[upper:upper + len(entry)] = entry
+            offsets.append(upper)
+        lower = self.HEADER + 2 * len(offsets)
+        assert lower <= upper
+        struct.pack_into(self.order + 'IIIIHH', body, 0,
+            pgno, prev_page, next_page, flags, lower, upper)
+        for index, offset in enumerate(offsets):
+            struct.pack_into(self.order + 'H', body,
+                self.HEADER + 2 * index, offset)
+        self.pages[pgno] = str(body)
+
+    def overflow(self, data):
+        size = self.PAGE_SIZE - self.HEADER
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        numbers = [self.new_page() for _ in chunks] + [0]
+        for index, chunk in enumerate(chunks):
+            body = bytearray(self.PAGE_SIZE)
+            struct.pack_into(self.order + 'IIIIHH', body, 0,
+                numbers[index], 0, numbers[index + 1], 0x04, 0, 0)
+            body[self.HEADER:self.HEADER + len(chunk)] = chunk
+            self.pages[numbers[index]] = str(body)
+        return struct.pack(self.order + 'II', numbers[0], len(data))
+
+    def leaf_entry(self, key, data):
+        flags = 0
+        if len(key) > self.INLINE:
+            key, flags = self.overflow(key), flags | gtagsdb.P_BIGKEY
+        if len(data) > self.INLINE:
+            data, flags = self.overflow(data), flags | gtagsdb.P_BIGDATA
+        return struct.pack(self.order + 'IIB', len(key), len(data),
+                           flags) + key + data
+
+    def internal_entry(self, key, pgno):
+        flags = 0
+        if len(key) > self.INLINE:
+            key, flags = self.overflow(key), gtagsdb.P_BIGKEY
+        return struct.pack(self.order + 'IIB', len(key), pgno, flags) + key
+
+    def write(self, path, records, per_leaf=4, fanout=3):
+        """Write (key, data) records; duplicates keep their order."""
+        records = sorted(((key + '\0', data + '\0')
+                          for key, data in records), key=lambda r: r[0])
+        groups = [records[i:i + per_leaf]
+                  for i in range(0, len(records), per_leaf)]
+        numbers = [self.new_page() for _ in groups] + [0]
+        level = []
+        for index, group in enumerate(groups):
+            self.write_page(numbers[index], gtagsdb.P_BLEAF,
+                [self.leaf_entry(key, data) for key, data in group],
+                numbers[index + 1], numbers[index - 1] if index else 0)
+            level.append((group[0][0], numbers[index]))
+        while len(level) > 1:
+            groups = [level[i:i + fanout]
+                      for i in range(0, len(level), fanout)]
+            level = []
+            for group in groups:
+                pgno = self.new_page() if len(groups) > 1 else 1
+                self.write_page(pgno, gtagsdb.P_BINTERNAL,
+                    [self.internal_entry('' if index == 0 else key, child)
+                     for index, (key, child) in enumerate(group)])
+                level.append((group[0][0], pgno))
+        if level[0][1] != 1:
+            self.pages[1] = self.pages[level[0][1]]
+        meta = bytearray(self.PAGE_SIZE)
+        struct.pack_into(self.order + 'IIIIII', meta, 0,
+            gtagsdb.BTREE_MAGIC, 3, self.PAGE_SIZE, 0, 0, 0)
+        self.pages[0] = str(meta)
+        with open(path, 'wb') as db_file:
+            db_file.write(''.join(page or '\0' * self.PAGE_SIZE
+                                  for page in self.pages))
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """gtagsdb on synthetic databases, in both byte orders."""
+
+    files = ['a.c', os.path.join('dir', 'b.c'), 'c.h']
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        rand = random.Random(1)
+        paths = [(' __.NEXTKEY', '4')]
+        for file_id, path in enumerate(self.files, 1):
+            path = './' + path.replace(os.sep, '/')
+            paths += [(path, str(file_id)), (str(file_id), path)]
+        self.names = ['n%03d' % i for i in range(60)] + ['x' * 80, 'dup']
+        self.expected = {}
+        tags = [(' __.COMPACT', '')]
+        for name in self.names:
+            for _ in range(12 if name == 'dup' else rand.randint(1, 3)):
+                file_id = rand.randint(1, 3)
+                line = rand.randint(1, 199)
+                # n010 has line images long enough for overflow pages.
+                image = 'image ' * (20 if name == 'n010' else 1)
+                tags.append((name, '%d %s %d %s' % (
+                    file_id, name, line, image)))
+                self.expected.setdefault(name, set()).add(
+                    (os.path.join(self.root, self.files[file_id - 1]), line))
+        references = [(' __.COMPACT', ''), (' __.COMPLINE', ''),
+                      ('n001', '1 n001 10,10,10-3,7'), ('n001', '2 n001 5'),
+                      ('undefined', '3 undefined 1')]
+        self.records = {'GPATH': paths, 'GTAGS': tags,
+                        'GRTAGS': references}
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, order):
+        for name, records in self.records.items():
+            BTreeWriter(order).write(os.path.join(self.root, name), records)
+        return gtagsdb.Database(self.root)
+
+    def test_lookup(self):
+        for order in '<>':
+            database = self.write(order)
+            for name in self.names:
+                self.assertEquals(database.lookup(name),
+                    sorted(self.expected[name]))
+            self.assertEquals(database.lookup('nope'), [])
+            self.assertEquals(database.lookup('n001', reference=True),
+                [(os.path.join(self.root, 'a.c'), line)
+                 for line in (10, 20, 30, 31, 32, 33, 40)] +
+                [(os.path.join(self.root, 'dir', 'b.c'), 5)])
+            # Like global -r: no references to undefined names.
+            self.assertEquals(database.lookup('undefined', reference=True),
+                [])
+            self.assertEquals(
+                database.lookup('undefined', reference=True, defined=True),
+                [(os.path.join(self.root, 'c.h'), 1)])
+
+    def test_names_and_paths(self):
+        database = self.write('<')
+        self.assertEquals(database.names('n00'),
+            ['n%03d' % i for i in range(10)])
+        self.assertEquals(database.names(''), sorted(self.names))
+        self.assertEquals(database.source_files('dir'), ['dir/b.c'])
+        self.assertEquals(database.file_id('c.h'), '3')
+
+    def test_rewritten_files(self):
+        database = self.write('<')
+        path = os.path.join(self.root, 'GTAGS')
+        # Truncated as by gtags starting a rebuild: a read error,
+        # not a crash, and no file is kept open.
+        open(path, 'w').close()
+        self.assertRaises(gtagsdb.READ_ERRORS, database.lookup, 'n001')
+        os.remove(path)
+        self.assertFalse(os.path.exists(path))
+
+
+class SymbolIndexTestCase(unittest.TestCase):
+    symbols = [
+        'LSQ_CreateSequence', 'LSQ_DestroySequence', 'LSQ_GetElementByIndex',
+        'LSQ_HandleT', 'LSQ_IteratorT', 'ListNode', 'list_length', 'main',
+    ]
+
+    def setUp(self):
+        self.index = symbolindex.SymbolIndex(list(reversed(self.symbols)))
+
+    def test_prefix(self):
+        self.assertEquals(self.index.prefix('LSQ_'), self.symbols[:5])
+        self.assertEquals(self.index.prefix('LSQ_', limit=2),
+            self.symbols[:2])
+        self.assertEquals(self.index.prefix('foobar'), [])
+        self.assertEquals(symbolindex.prefix_symbols(self.symbols, 'list'),
+            ['list_length'])
+
+    def test_contains(self):
+        self.assertTrue('LSQ_HandleT' in self.index)
+        self.assertFalse('LSQ_Get' in self.index)
+
+    def test_search(self):
+        self.assertEquals(self.index.search('Sequence'),
+            ['LSQ_CreateSequence', 'LSQ_DestroySequence'])
+        self.assertEquals(self.index.search('list'),
+            ['list_length', 'ListNode'])
+        self.assertEquals(self.index.search('t'), [
+            'LSQ_CreateSequence', 'LSQ_DestroySequence',
+            'LSQ_GetElementByIndex', 'LSQ_HandleT', 'LSQ_IteratorT',
+            'ListNode', 'list_length'])
+        self.assertEquals(self.index.search('ai'), ['main'])
+        self.assertEquals(self.index.search('elementbyi', limit=1),
+            ['LSQ_GetElementByIndex'])
+        self.assertEquals(self.index.search('xyz'), [])
+
+
+class TaskExecutorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.executor = tasks.TaskExecutor(workers=4)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+
+    def blocking(self, task):
+        self.release.wait(5)
+
+    def wait(self, *all_tasks):
+        for task in all_tasks:
+            done = threading.Event()
+            task.on_done(lambda task: done.set())
+            self.assertTrue(done.wait(5))
+
+    def test_deduplication(self):
+        first = self.executor.submit(tasks.Task(self.blocking, key='a'))
+        second = self.executor.submit(tasks.Task(self.blocking, key='a'))
+        self.assertTrue(first is second)
+        self.release.set()
+        self.wait(first)
+        self.assertTrue(first.success)
+
+    def test_writers_of_a_root_are_serialized(self):
+        lock = threading.Lock()
+        overlaps = []
+
+        def write(task):
+            if not lock.acquire(False):
+                overlaps.append(task)
+                return False
+            try:
+                self.release.wait(0.05)
+            finally:
+                lock.release()
+
+        writers = [
+            self.executor.submit(tasks.Task(write, root='r', writer=True))
+            for _ in range(4)]
+        self.wait(*writers)
+        self.assertEquals(overlaps, [])
+        self.assertTrue(all(writer.success for writer in writers))
+
+    def test_group_cancels_stale_tasks(self):
+        cancelled = threading.Event()
+
+        def stale(task):
+            task.on_cancel(cancelled.set)
+            self.release.wait(5)
+
+        first = self.executor.submit(tasks.Task(stale, group='search'))
+        while not first.started:
+            self.release.wait(0.01)
+        second = self.executor.submit(
+            tasks.Task(lambda task: 42, group='search'))
+        self.assertTrue(cancelled.wait(5))
+        self.release.set()
+        self.wait(first, second)
+        self.assertFalse(first.success)
+        self.assertEquals(second.result, 42)
+
+    def test_priority(self):
+        executor = tasks.TaskExecutor(workers=1)
+        order = []
+        running = executor.submit(tasks.Task(self.blocking))
+        low = executor.submit(tasks.Task(
+            lambda task: order.append('low'), priority=-1))
+        normal = executor.submit(tasks.Task(lambda task: order.append('normal')))
+        self.release.set()
+        self.wait(running, low, normal)
+        self.assertEquals(order, ['normal', 'low'])
+
+    def test_pool_limit(self):
+        executor = tasks.TaskExecutor(workers=2)
+        executor.pool_limits['prefetch'] = 1
+        order = []
+        lock = threading.Lock()
+
+        def prefetch(task):
+            with lock:
+                order.append('prefetch')
+            self.release.wait(5)
+
+        def search(task):
+            with lock:
+                order.append('search')
+
+        prefetches = [executor.submit(tasks.Task(prefetch, pool='prefetch',
+                                                 priority=-1))
+                      for _ in range(2)]
+        while not prefetches[0].started:
+            self.release.wait(0.01)
+        searched = executor.submit(tasks.Task(search))
+        self.wait(searched)
+        self.assertFalse(prefetches[1].started)
+        self.release.set()
+        self.wait(*prefetches)
+        self.assertEquals(order, ['prefetch', 'search', 'prefetch'])
+
+    def test_cancel_queued_task(self):
+        executor = tasks.TaskExecutor(workers=1)
+        running = executor.submit(tasks.Task(self.blocking))
+        queued = executor.submit(tasks.Task(lambda task: 42))
+        executor.cancel(queued)
+        self.release.set()
+        self.wait(running, queued)
+        self.assertTrue(queued.cancelled)
+        self.assertEquals(queued.result, None)
+
+
+class PathsTestCase(unittest.TestCase):
+    def test_long_path(self):
+        calls = []
+
+        def convert(path):
+            calls.append(path)
+            return path.replace('LONGNA~1', 'long name')
+
+        clear_path_memos()
+        paths = [os.path.join('LONGNA~1', name) for name in ('a.c', 'b.c')]
+        self.assertEquals([long_path(path, convert) for path in paths],
+            [os.path.join('long name', name) for name in ('a.c', 'b.c')])
+        self.assertEquals(calls, ['LONGNA~1'])
+        self.assertEquals(long_path('plain', convert), 'plain')
+
+    def test_per_directory(self):
+        relative = per_directory(lambda path: os.path.relpath(path, 'root'))
+        self.assertEquals(relative(os.path.join('root', 'a.c')), 'a.c')
+        self.assertEquals(relative(os.path.join('root', 'dir', 'a.c')),
+            os.path.join('dir', 'a.c'))
+        self.assertEquals(relative(os.path.join('other', 'a.c')),
+            os.path.join(os.pardir, 'other', 'a.c'))
+
+    def test_command_arguments(self):
+        self.assertEquals(gtags.command_arguments(u'global -f \xe9.c'),
+            ['global', '-f', '\xc3\xa9.c'])
+        self.assertEquals(gtags.command_arguments(['global', u'\xe9.c']),
+            ['global', '\xc3\xa9.c'])
+        if is_windows():
+            return
+        worker = gtags.QueryWorker(dict(os.environ))
+        try:
+            self.assertEquals(worker.query(['echo', u'\xe9.c']),
+                '\xc3\xa9.c\n')
+        finally:
+            worker.close()
+
+    def test_lowered_priority(self):
+        if is_windows():
+            return
+        search_path = os.environ['PATH']
+        command, kwargs = gtags.lowered_priority(['gtags', '-i'],
+                                                 search_path, nice=5)
+        self.assertEquals(kwargs, {})
+        nice = gtags.find_executable('nice', search_path)
+        if nice is not None:
+            self.assertEquals(command, [nice, '-n', '5', 'gtags', '-i'])
+        self.assertEquals(gtags.lowered_priority(['gtags'], search_path),
+            (['gtags'], {}))
+
+    def test_universal_normalize(self):
+        path = os.path.join('a', '.', 'b')
+        self.assertEquals(universal_normalize(path),
+            universal_normalize(os.path.join('a', 'b')))
+
+
+class WatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write('kept.c')
+        self.write('removed.c')
+        self.batches = []
+        self.changed = threading.Event()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, *parts):
+        path = os.path.join(self.root, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as source:
+            source.write('int f();\n')
+
+    def callback(self, paths):
+        self.batches.append(paths)
+        self.changed.set()
+
+    def check(self, root_watcher):
+        try:
+            root_watcher.start()
+            self.assertTrue(root_watcher.ready.wait(10))
+            self.write('kept.c')
+            self.write('notes.txt')
+            self.write('new', 'added.c')
+            os.remove(os.path.join(self.root, 'removed.c'))
+            self.assertTrue(self.changed.wait(10))
+        finally:
+            root_watcher.stop()
+        self.assertEquals(len(self.batches), 1)
+        self.assertEquals(self.batches[0], sorted(
+            os.path.join(self.root, *parts) for parts in
+            [('kept.c',), ('removed.c',), ('new', 'added.c')]))
+
+    def test_polling(self):
+        self.check(watcher.PollingWatcher(
+            self.root, self.callback, interval=0.1, poll_interval=0.1))
+
+    def test_inotify(self):
+        try:
+            root_watcher = watcher.InotifyWatcher(
+                self.root, self.callback, interval=0.1)
+        except (OSError, AttributeError):
+            return
+        self.check(root_watcher)
+
+    def test_inotify_fallback(self):
+        try:
+            root_watcher = watcher.InotifyWatcher(
+                self.root, self.callback, interval=0.1, poll_interval=0.1)
+        except (OSError, AttributeError):
+            return
+        # As when out of inotify watches.
+        def setup():
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        root_watcher.setup = setup
+        self.check(root_watcher)
+
+
+class TimingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = tempfile.mktemp()
+
+    def tearDown(self):
+        timing.configure(False)
+        if os.path.exists(self.log):
+            os.remove(self.log)
+
+    def test_disabled(self):
+        timing.configure(False)
+        self.assertTrue(timing.start('navigate') is timing.NULL_TIMER)
+        with timing.start('navigate') as timer:
+            self.assertTrue(timing.phase('global') is timing.NULL_TIMER)
+            timer.count(1)
+        self.assertEquals(timing.recorder(), None)
+
+    def test_phases(self):
+        timing.configure(True, history=3, log_path=self.log)
+        for results in range(5):
+            with timing.start('navigate', 'root') as timer:
+                with timing.phase('global'):
+                    pass
+                with timing.phase('parse'):
+                    pass
+                with timing.phase('parse'):
+                    pass
+                timer.count(results)
+        self.assertTrue(timing.phase('global') is timing.NULL_TIMER)
+
+        summary = timing.recorder().summary()
+        self.assertEquals(len(summary), 1)
+        self.assertEquals(summary[0]['count'], 3)
+        self.assertEquals(sorted(summary[0]['phases']), ['global', 'parse'])
+        self.assertEquals(summary[0]['results'],
+            {'p50': 3, 'p90': 4, 'p99': 4, 'max': 4})
+        with open(self.log) as log:
+            self.assertEquals(len(log.readlines()), 5)
+
+    def test_operation_across_threads(self):
+        timing.configure(True)
+        timer = timing.start('find_references')
+
+        def work():
+            with timer.bind():
+                with timing.phase('global'):
+                    pass
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertEquals(len(timing.recorder().records), 0)
+        timer.finish()
+        timer.finish()
+        records = list(timing.recorder().records)
+        self.assertEquals(len(records), 1)
+        self.assertEquals(records[0]['phases'].keys(), ['global'])
+
+
 if __name__ == '__main__':
     tests = [
         'test_version_comparison',
         'test_build',
+        'test_sharded_build',
+        'test_rebuild_changed',
+        'test_build_progress',
+        'test_cancel_build',
+        'test_find_tags_root',
         'test_version',
+        'test_capabilities',
         'test_get_by_prefix',
+        'test_symbol_cache',
         'test_empty_match',
         'test_match',
         'test_references',
-        'test_single_update'
+        'test_tag_record',
+        'test_query_cache',
+        'test_fanout',
+        'test_direct_backend',
+        'test_lazy_context',
+        'test_match_many',
+        'test_cancel',
+        'test_stream_match',
+        'test_stream_timeout',
+        'test_single_update',
+        'test_update_files',
+        'test_patch_symbols',
+        'test_persistent_worker',
     ]
     suite = unittest.TestSuite(map(GtagsTestCase, tests))
+    suite.addTests(unittest.makeSuite(DatabaseTestCase))
+    suite.addTests(unittest.makeSuite(SymbolIndexTestCase))
+    suite.addTests(unittest.makeSuite(TaskExecutorTestCase))
+    suite.addTests(unittest.makeSuite(PathsTestCase))
+    suite.addTests(unittest.makeSuite(TimingTestCase))
+    suite.addTests(unittest.makeSuite(WatcherTestCase))
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import math
+import threading
+import time
+
+
+class NullTimer(object):
+    """Stands in for operations and phases while timing is disabled."""
+
+    root = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def phase(self, name):
+        return self
+
+    def count(self, results):
+        pass
+
+    def bind(self):
+        return self
+
+    def finish(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Phase(object):
+    __slots__ = ('operation', 'name', 'started')
+
+    def __init__(self, operation, name):
+        self.operation = operation
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.operation.add(self.name, time.time() - self.started)
+        return False
+
+
+class Binding(object):
+    """Makes an operation the current one of a thread for a block."""
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        self.previous = getattr(_current, 'operation', None)
+        _current.operation = self.operation
+        return self.operation
+
+    def __exit__(self, *exc_info):
+        _current.operation = self.previous
+        return False
+
+
+class Operation(object):
+    """Timings of one command, possibly spanning several threads.
+
+    Phases with the same name add up. Used as a context manager
+    the operation is bound to the thread and finished on exit;
+    otherwise bind() it where work is done and finish() it when done.
+    """
+
+    def __init__(self, recorder, name, root=None):
+        self.recorder = recorder
+        self.name = name
+        self.root = root
+        self.started = time.time()
+        self.phases = {}
+        self.results = None
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.binding = Binding(self)
+        return self.binding.__enter__()
+
+    def __exit__(self, *exc_info):
+        self.binding.__exit__(*exc_info)
+        self.finish()
+        return False
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, results):
+        self.results = results
+
+    def bind(self):
+        return Binding(self)
+
+    def finish(self):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        self.recorder.record({
+            'operation': self.name,
+            'root': self.root,
+            'started': self.started,
+            'total': time.time() - self.started,
+            'phases': dict(self.phases),
+            'results': self.results,
+        })
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def distribution(values):
+    values = sorted(values)
+    return {
+        'p50': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'p99': percentile(values, 0.99),
+        'max': values[-1],
+    }
+
+
+class Recorder(object):
+    """Keeps the last `history` finished operations in a ring buffer.
+
+    Every record is also appended to log_path as a line of JSON
+    if it is set.
+    """
+
+    def __init__(self, history=1000, log_path=None):
+        self.records = collections.deque(maxlen=history)
+        self.log_path = log_path
+        self.lock = threading.Lock()
+
+    def record(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.log_path:
+                try:
+                    with open(self.log_path, 'a') as log:
+                        log.write(json.dumps(record) + '\n')
+                except (IOError, OSError) as e:
+                    print 'GTags: cannot write timing log: %s' % e
+                    self.log_path = None
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+    def summary(self):
+        """Return percentiles of durations per operation and root."""
+        with self.lock:
+            records = list(self.records)
+        groups = collections.defaultdict(list)
+        for record in records:
+            groups[(record['operation'], record['root'])].append(record)
+
+        result = []
+        for (operation, root), group in sorted(groups.items()):
+            phases = collections.defaultdict(list)
+            for record in group:
+                for name, seconds in record['phases'].items():
+                    phases[name].append(seconds)
+            results = [record['results'] for record in group
+                       if record['results'] is not None]
+            result.append({
+                'operation': operation,
+                'root': root,
+                'count': len(group),
+                'total': distribution([record['total'] for record in group]),
+                'phases': dict((name, distribution(values))
+                               for name, values in phases.items()),
+                'results': distribution(results) if results else None,
+            })
+        return result
+
+
+_recorder = None
+_current = threading.local()
+
+
+def configure(enabled, history=1000, log_path=None):
+    """Turn timing on or off, keeping the records of the same history."""
+    global _recorder
+    if not enabled:
+        _recorder = None
+    elif _recorder is None or _recorder.records.maxlen != history:
+        _recorder = Recorder(history, log_path)
+    else:
+        _recorder.log_path = log_path
+
+
+def recorder():
+    return _recorder
+
+
+def start(name, root=None):
+    """Return a new operation, or NULL_TIMER if timing is disabled."""
+    if _recorder is None:
+        return NULL_TIMER
+    return Operation(_recorder, name, root)
+
+
+def current():
+    if _recorder is None:
+        return NULL_TIMER
+    return getattr(_current, 'operation', None) or NULL_TIMER
+
+
+def phase(name):
+    """Time a block as a phase of the current operation of the thread."""
+    if _recorder is None:
+        return NULL_TIMER
+    operation = getattr(_current, 'operation', None)
+    if operation is None:
+        return NULL_TIMER
+    return operation.phase(name)
+
+
+def format_summary(summary):
+    lines = []
+    milliseconds = lambda values: '%8.1f %8.1f %8.1f %8.1f' % tuple(
+        1000 * values[key] for key in ('p50', 'p90', 'p99', 'max'))
+    for entry in summary:
+        lines.append('%s  %s  (%d runs%s)' % (
+            entry['operation'], entry['root'] or '-', entry['count'],
+            ', %d results p50' % entry['results']['p50']
+            if entry['results'] else ''))
+        lines.append('    %-20s %8s %8s %8s %8s' % (
+            'ms', 'p50', 'p90', 'p99', 'max'))
+        lines.append('    %-20s %s' % ('total', milliseconds(entry['total'])))
+        for name, values in sorted(entry['phases'].items()):
+            lines.append('    %-20s %s' % (name, milliseconds(values)))
+        lines.append('')
+    return '\n'.join(lines)
@@ -4,8 +4,11 @@ import os
 import platform
 
 
+_IS_WINDOWS = platform.system() == 'Windows'
+
+
 def is_windows():
-    return platform.system() == 'Windows'
+    return _IS_WINDOWS
 
 
 if is_windows():
@@ -46,11 +49,95 @@ def prepare_path_for_env(path):
     return path
 
 
+def find_executable(name, search_path):
+    extensions = ['']
+    if is_windows():
+        extensions = os.environ.get('PATHEXT', '.exe').split(os.pathsep)
+    for directory in search_path.split(os.pathsep):
+        for extension in extensions:
+            path = os.path.join(directory, name + extension)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+
+# Memoized conversions are dropped wholesale above this many entries.
+PATH_MEMO_LIMIT = 16384
+
+_long_directories = {}
+_decoded_directories = {}
+_normalized_paths = {}
+
+
+def _memoized(memo, key, func):
+    try:
+        return memo[key]
+    except KeyError:
+        if len(memo) >= PATH_MEMO_LIMIT:
+            memo.clear()
+        value = memo[key] = func(key)
+        return value
+
+
+def clear_path_memos():
+    for memo in (_long_directories, _decoded_directories, _normalized_paths):
+        memo.clear()
+
+
+def long_path(path, convert=None):
+    """Expand 8.3 names of a Windows path, converting each directory once.
+
+    Only components containing '~' can be short names, so other paths
+    are returned as they are and other file names are just joined.
+    """
+    if '~' not in path:
+        return path
+    convert = convert or convert_from_83
+    directory, name = os.path.split(path)
+    directory = _memoized(_long_directories, directory, convert)
+    if '~' in name:
+        return convert(os.path.join(directory, name))
+    return os.path.join(directory, name)
+
+
+def from_global_path(path):
+    """Convert a path printed by global to the original unicode path."""
+    if not is_windows():
+        return path
+    # Decode from the CMD encoding and expand 8.3 names once per directory.
+    directory, name = os.path.split(path)
+    directory = _memoized(_decoded_directories, directory,
+        lambda directory: long_path(
+            directory.decode(locale.getpreferredencoding())))
+    return long_path(os.path.join(
+        directory, name.decode(locale.getpreferredencoding())))
+
+
+def per_directory(func):
+    """Return func for file paths which calls it once per directory.
+
+    func must map a directory to a directory, like os.path.normpath
+    or os.path.relpath; file names are joined to its results.
+    """
+    directories = {}
+
+    def convert(path):
+        directory, name = os.path.split(path)
+        try:
+            converted = directories[directory]
+        except KeyError:
+            converted = directories[directory] = func(directory or os.curdir)
+        if converted == os.curdir:
+            return name
+        return os.path.join(converted, name)
+    return convert
+
+
 def use_forward_slashes(path):
     return path.replace('\\\\', '/').replace('\\', '/')
 
 
-def universal_normalize(path):
+def _universal_normalize(path):
     functions = (
         os.path.realpath,
         os.path.expanduser,
@@ -64,7 +151,16 @@ def universal_normalize(path):
     return path
 
 
+def universal_normalize(path):
+    """Return a canonical form of path, memoized.
+
+    Call clear_path_memos() after symlinks or environment variables
+    the path goes through have changed.
+    """
+    return _memoized(_normalized_paths, path, _universal_normalize)
+
+
 def is_paths_equal(a, b):
     if is_windows():
-        a, b = map(convert_from_83, (a, b))
+        a, b = map(long_path, (a, b))
     return universal_normalize(a) == universal_normalize(b)
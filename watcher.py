@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+import gtags
+from utils import *
+
+# inotify(7) constants.
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE)
+EVENT = struct.Struct('iIII')
+
+# Changes are batched until there has been none for this many seconds...
+QUIET_PERIOD = 1.0
+# ...but batches are never held back longer than this many intervals.
+MAX_WAIT_INTERVALS = 10
+
+
+class Watcher(object):
+    """Collects source files of a tags root changed outside the editor.
+
+    callback(paths) is called on the watcher thread with sorted absolute
+    paths of added, modified and deleted files, once changes have settled
+    and at most every `interval` seconds. paths is None when changes
+    were lost and the whole root has to be reindexed.
+
+    Anything which reads the tree is done in setup(), on the watcher
+    thread, so that start() returns at once. Subclasses collect changes
+    in wait_for_changes().
+    """
+
+    def __init__(self, root, callback, interval=2.0):
+        self.root = root
+        self.callback = callback
+        self.interval = interval
+        self.pending = set()
+        self.overflowed = False
+        self.last_change = 0
+        self.first_change = 0
+        self.last_flush = 0
+        self.stopped = threading.Event()
+        # Set once setup() is done and changes are being watched.
+        self.ready = threading.Event()
+        self.thread = None
+        self.listed = None
+
+    def setup(self):
+        if os.path.isfile(os.path.join(self.root, 'gtags.files')):
+            self.listed = set(os.path.normpath(os.path.join(self.root, path))
+                              for path in gtags.list_source_files(self.root))
+
+    def is_source(self, path):
+        if self.listed is not None:
+            return path in self.listed
+        if os.path.splitext(path)[1] not in gtags.SOURCE_SUFFIXES:
+            return False
+        relative = os.path.relpath(path, self.root)
+        return not any(part.startswith('.')
+                       for part in relative.split(os.sep))
+
+    def add(self, path):
+        path = os.path.normpath(path)
+        if not self.is_source(path):
+            return
+        now = time.time()
+        if not self.pending:
+            self.first_change = now
+        self.pending.add(path)
+        self.last_change = now
+
+    def overflow(self):
+        self.overflowed = True
+        self.last_change = time.time()
+        self.first_change = self.first_change or self.last_change
+
+    def flush_if_due(self):
+        if not (self.pending or self.overflowed):
+            return
+        now = time.time()
+        settled = (now - self.last_change >= QUIET_PERIOD or
+                   now - self.first_change >=
+                   MAX_WAIT_INTERVALS * self.interval)
+        if not settled or now - self.last_flush < self.interval:
+            return
+        paths = None if self.overflowed else sorted(self.pending)
+        self.pending = set()
+        self.overflowed = False
+        self.first_change = 0
+        self.last_flush = now
+        try:
+            self.callback(paths)
+        except Exception as e:
+            print 'GTags watcher callback failed: %s' % e
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def wait_for_changes(self):
+        """Collect changes for a while; the base class only waits."""
+        self.stopped.wait(self.interval)
+
+    def close(self):
+        pass
+
+    def fall_back(self, error):
+        """Called on the watcher thread when setup() failed."""
+        print 'GTags: cannot watch %s: %s' % (self.root, error)
+
+    def _run(self):
+        try:
+            self.setup()
+        except EnvironmentError as e:
+            self.close()
+            self.fall_back(e)
+            return
+        self.ready.set()
+        try:
+            while not self.stopped.is_set():
+                self.wait_for_changes()
+                self.flush_if_due()
+        finally:
+            self.close()
+
+
+class PollingWatcher(Watcher):
+    """Finds changes by comparing sizes and mtimes of all source files."""
+
+    def __init__(self, root, callback, interval=2.0, poll_interval=10.0):
+        Watcher.__init__(self, root, callback, interval)
+        self.poll_interval = poll_interval
+        self.manifest = gtags.FileManifest(root)
+        self.files = None
+        self.next_poll = 0
+
+    def setup(self):
+        Watcher.setup(self)
+        self.files = self.manifest.scan()
+        self.next_poll = time.time() + self.poll_interval
+
+    def poll(self):
+        files = self.manifest.scan()
+        for path in gtags.FileManifest.changes(self.files, files):
+            self.add(os.path.join(self.root, path))
+        self.files = files
+
+    def wait_for_changes(self):
+        if self.stopped.wait(min(self.interval, self.poll_interval)):
+            return
+        if time.time() >= self.next_poll:
+            self.poll()
+            self.next_poll = time.time() + self.poll_interval
+
+
+class InotifyWatcher(Watcher):
+    """Watches every directory of the root with Linux inotify.
+
+    Falls back to polling every `poll_interval` seconds when the tree
+    cannot be watched, typically when out of inotify watches.
+    """
+
+    def __init__(self, root, callback, interval=2.0, poll_interval=10.0):
+        Watcher.__init__(self, root, callback, interval)
+        self.poll_interval = poll_interval
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        # Raises AttributeError where inotify is not available.
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+
+    def setup(self):
+        Watcher.setup(self)
+        self.watch_tree(self.root)
+
+    def watch_tree(self, top, report=False):
+        """Watch top and its subdirectories; report their files if asked.
+
+        Files of directories created after the watch was set up may be
+        written before their watch exists, so they are reported as added.
+        """
+        for directory, directories, files in os.walk(top):
+            directories[:] = [name for name in directories
+                              if not name.startswith('.')]
+            if isinstance(directory, unicode):
+                directory = directory.encode('utf-8')
+            wd = self.add_watch(self.fd, directory, WATCH_MASK)
+            if wd < 0:
+                code = ctypes.get_errno()
+                if directory == top or code == errno.ENOSPC:
+                    # Out of watches: the caller falls back to polling.
+                    raise OSError(code, os.strerror(code))
+                continue
+            self.directories[wd] = directory
+            if report:
+                for name in files:
+                    self.add(os.path.join(directory, name))
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflow()
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if (mask & (IN_CREATE | IN_MOVED_TO) and
+                        not name.startswith('.')):
+                    try:
+                        self.watch_tree(path, report=True)
+                    except OSError:
+                        self.overflow()
+                elif mask & IN_MOVED_FROM:
+                    # Files of a directory moved away are gone.
+                    self.overflow()
+            else:
+                self.add(path)
+
+    def wait_for_changes(self):
+        ready, _, _ = select.select([self.fd], [], [], 0.5)
+        if ready:
+            self.read_events()
+
+    def close(self):
+        os.close(self.fd)
+
+    def fall_back(self, error):
+        print 'GTags: watching %s by polling: %s' % (self.root, error)
+        polling = PollingWatcher(self.root, self.callback, self.interval,
+                                 self.poll_interval)
+        # Stopping this watcher stops the polling one.
+        polling.stopped = self.stopped
+        polling.ready = self.ready
+        polling._run()
+
+
+def create_watcher(root, callback, interval=2.0, poll_interval=10.0):
+    """Return a started watcher, polling where inotify is not usable.
+
+    Does not read the tree: the watcher thread does, see Watcher.
+    """
+    watcher = None
+    if not is_windows():
+        try:
+            watcher = InotifyWatcher(root, callback, interval, poll_interval)
+        except (OSError, AttributeError) as e:
+            print 'GTags: watching %s by polling: %s' % (root, e)
+    if watcher is None:
+        watcher = PollingWatcher(root, callback, interval, poll_interval)
+    watcher.start()
+    return watcher